@@ -1,7 +1,14 @@
 import streamlit as st
+from streamlit import runtime as st_runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import yfinance as yf
+import pandas as pd
+from pandas.tseries.holiday import (AbstractHolidayCalendar, GoodFriday, Holiday, USLaborDay, USMartinLutherKingJr,
+                                    USMemorialDay, USPresidentsDay, USThanksgivingDay, nearest_workday, sunday_to_monday)
+import numpy as np
 import pandas_ta as ta
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, DefaultHttpxClient, NotFoundError, OpenAI
+import httpx
 import time
 import requests
 import gspread
@@ -9,13 +16,137 @@ from oauth2client.service_account import ServiceAccountCredentials
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import tempfile
+import shutil
+from pypdf import PdfReader
 import os 
-
-
-api_key = st.secrets["auth_token"]
-
-
-client = OpenAI(api_key=api_key)
+import io
+import sys
+import argparse
+import re
+import uuid
+import json
+import hashlib
+import tiktoken
+import threading
+import warnings
+from collections import OrderedDict, deque
+from itertools import product
+from contextlib import contextmanager, nullcontext
+import queue
+import random
+from numpy.lib.stride_tricks import sliding_window_view
+import sqlite3
+from datetime import datetime, time as dtime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from dataclasses import asdict, dataclass, field
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+
+
+# Upper bound on simultaneous OpenAI requests for the per-indicator analyses
+LLM_MAX_WORKERS = int(os.environ.get("LLM_MAX_WORKERS", "6"))
+# Default for the "Single-call Indicator Analysis" option: one structured request for every
+# indicator and the summary instead of one request each
+INDICATOR_CONSOLIDATED = os.environ.get("INDICATOR_CONSOLIDATED", "0") == "1"
+
+# Make.com scenarios and the sheet they write to (override to point at a local stand-in)
+NEWS_WEBHOOK_URL = os.environ.get("NEWS_WEBHOOK_URL", "https://hook.eu2.make.com/s4xsnimg9v87rrrckcwo88d9k57186q6")
+FA_WEBHOOK_URL = os.environ.get("FA_WEBHOOK_URL", "https://hook.eu2.make.com/d68cwl3ujkpqmgrnbpgy9mx3d06vs198")
+RESULTS_SHEET_URL = os.environ.get("RESULTS_SHEET_URL", "https://docs.google.com/spreadsheets/d/1-cDCZDq8r1rGDVYpY_JhQvb0srhqsIiPhGWaxRC1TPw/edit?usp=sharing")
+
+# Scenario results are stored one row per job; "sqlite" keeps them in a local file instead
+RESULT_STORE = os.environ.get("RESULT_STORE", "sheet")
+RESULTS_WORKSHEET = os.environ.get("RESULTS_WORKSHEET", "Results")
+RESULT_DB_PATH = os.environ.get("RESULT_DB_PATH", os.path.join(tempfile.gettempdir(), "momentum_results.sqlite3"))
+
+# Job rows older than this are deleted
+RESULT_RETENTION = float(os.environ.get("RESULT_RETENTION", str(24 * 3600)))
+
+# Daily OHLCV bars are kept per ticker on disk, with the most recently used tickers held in memory
+PRICE_CACHE_DIR = os.environ.get("PRICE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "momentum_prices"))
+PRICE_CACHE_SIZE = int(os.environ.get("PRICE_CACHE_SIZE", "64"))
+
+# One download covers the longest timeframe plus warm-up for SMA_200, the longest indicator
+INDICATOR_HISTORY_PERIOD = "2y"
+
+# OpenAI completions are cached on disk by a hash of (model, messages, parameters)
+COMPLETION_CACHE_DIR = os.environ.get("COMPLETION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "momentum_completions"))
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", str(24 * 3600)))
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Fundamental reports and OpenAI file IDs are cached on disk by the SHA-256 of the uploaded PDF
+FILING_CACHE_DIR = os.environ.get("FILING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "momentum_filings"))
+FILING_CACHE_TTL = float(os.environ.get("FILING_CACHE_TTL", str(30 * 24 * 3600)))
+FILING_CACHE_MAX_BYTES = int(os.environ.get("FILING_CACHE_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Indicator narratives are reused while the indicator's signal state is unchanged since the last run;
+# a snapshot older than the TTL is ignored so every narrative is refreshed at least that often
+SIGNAL_PRESCREEN = os.environ.get("SIGNAL_PRESCREEN", "1") == "1"
+SIGNAL_SNAPSHOT_DIR = os.environ.get("SIGNAL_SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "momentum_signals"))
+SIGNAL_SNAPSHOT_TTL = float(os.environ.get("SIGNAL_SNAPSHOT_TTL", str(7 * 24 * 3600)))
+
+# Symbols per multi-ticker yf.download request in watchlist mode
+WATCHLIST_CHUNK_SIZE = int(os.environ.get("WATCHLIST_CHUNK_SIZE", "100"))
+
+# US equity session used to decide when a new daily bar can exist
+MARKET_TZ = ZoneInfo("America/New_York")
+MARKET_CLOSE = dtime(16, 0)
+
+# Hard limit on how long to wait for a scenario before giving up
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "180"))
+
+# One OpenAI connection pool per process, sized above LLM_MAX_WORKERS so watchlist summaries never queue for a socket
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "60"))
+# Every OpenAI request goes through one gateway per process, which keeps under these per-minute
+# limits, retries 429s, 5xx errors and dropped connections with jittered exponential backoff,
+# and serves waiting users in turn
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "200000"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "5"))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "1.0"))
+OPENAI_BACKOFF_MAX = float(os.environ.get("OPENAI_BACKOFF_MAX", "30"))
+# Completion tokens reserved for a request that does not set max_tokens
+OPENAI_COMPLETION_ESTIMATE = int(os.environ.get("OPENAI_COMPLETION_ESTIMATE", "800"))
+
+# "local" extracts and summarizes annual reports in-process; "webhook" hands them to the Make.com scenario
+FUNDAMENTAL_BACKEND = os.environ.get("FUNDAMENTAL_BACKEND", "local")
+# Token budgets for one report chunk sent to the model, and for all chunk notes passed to the final report
+FILING_CHUNK_TOKENS = int(os.environ.get("FILING_CHUNK_TOKENS", "6000"))
+FILING_NOTES_TOKENS = int(os.environ.get("FILING_NOTES_TOKENS", "16000"))
+
+# Screener universe source; the constituent list is cached beside the price data for a week
+SP500_URL = os.environ.get("SP500_URL", "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies")
+
+# Watchlist analysed ahead of time, as "TICKER=Company Name" entries separated by commas (the
+# company is only needed for news). Runs on weekdays at the given market-time HH:MM slots.
+PRECOMPUTE_WATCHLIST = os.environ.get("PRECOMPUTE_WATCHLIST", "")
+PRECOMPUTE_TIMEFRAMES = [name.strip() for name in os.environ.get("PRECOMPUTE_TIMEFRAMES", "1 Year").split(",") if name.strip()]
+PRECOMPUTE_NEWS = os.environ.get("PRECOMPUTE_NEWS", "0") == "1"
+PRECOMPUTE_SCHEDULE = os.environ.get("PRECOMPUTE_SCHEDULE", "16:30")
+PRECOMPUTE_WORKERS = int(os.environ.get("PRECOMPUTE_WORKERS", "2"))
+PRECOMPUTE_DB_PATH = os.environ.get("PRECOMPUTE_DB_PATH", os.path.join(tempfile.gettempdir(), "momentum_precomputed.sqlite3"))
+# Precomputed results older than this are not served
+PRECOMPUTE_MAX_AGE = float(os.environ.get("PRECOMPUTE_MAX_AGE", str(3 * 24 * 3600)))
+# Run the scheduler on a daemon thread inside the Streamlit process instead of `python Momentum_app_2.py precompute`
+PRECOMPUTE_IN_APP = os.environ.get("PRECOMPUTE_IN_APP", "0") == "1"
+
+# Single-ticker analyses run as queued jobs: "thread" starts JOB_WORKERS worker threads in the app
+# process, "external" leaves them to `python Momentum_app_2.py worker`, "inline" runs on the script thread
+JOB_MODE = os.environ.get("JOB_MODE", "thread")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "momentum_jobs.sqlite3"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))
+# A running job without a progress update for this long is assumed orphaned and handed to another worker
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", "900"))
+
+# Timing spans of every pipeline run are appended here as JSON lines; set it to "" to turn the export off.
+# The file is rotated to <path>.1 once it grows past TRACE_LOG_MAX_BYTES
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", os.path.join(tempfile.gettempdir(), "momentum_spans.jsonl"))
+TRACE_LOG_MAX_BYTES = int(os.environ.get("TRACE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Finished analyses kept per browser session, so reruns redraw them instead of running again
+SESSION_RESULT_LIMIT = int(os.environ.get("SESSION_RESULT_LIMIT", "10"))
 
 
 def main():
@@ -23,14 +154,44 @@ def main():
 # Main application
     st.set_page_config(page_title="Stock Market Analysis", layout="wide", page_icon="📈")
 
+    if PRECOMPUTE_IN_APP:
+        start_precompute_scheduler()
+    if JOB_MODE == "thread":
+        start_job_workers()
+    set_llm_user(session_user())
+
     # Sidebar with interactive options
     with st.sidebar:
         st.title("Market Analysis Dashboard")
         st.markdown("Analyze stock trends using advanced technical indicators powered by AI.")
-        
-        # Ticker Input
-        ticker = st.text_input(" Enter Ticker Symbol", "", help="Example: 'AAPL' for Apple Inc.")
-        company = st.text_input(" Enter Full Company Name", "", help="Example: 'Apple Inc.'")
+
+        mode = st.radio("Mode", ("Single Ticker", "Watchlist", "Screener", "Backtest"), horizontal=True, key="mode",
+                        help="Analyze one stock in depth, a list of tickers at once, rank a whole universe by momentum, "
+                             "or test the indicator rules on history")
+
+        if mode == "Watchlist":
+            watchlist_text = st.text_area(" Enter Ticker Symbols", "", help="Separate symbols with commas, spaces or new lines")
+        elif mode == "Screener":
+            universe = st.selectbox("Universe", ("S&P 500", "Custom List"))
+            screener_text = ""
+            if universe == "Custom List":
+                screener_text = st.text_area(" Enter Ticker Symbols", "", help="Separate symbols with commas, spaces or new lines")
+            top_n = st.number_input("Show Top", min_value=5, max_value=500, value=25, step=5)
+        elif mode == "Backtest":
+            backtest_text = st.text_area(" Enter Ticker Symbols", "", help="Separate symbols with commas, spaces or new lines")
+            years = st.slider("Years of History", min_value=1, max_value=10, value=10)
+            strategy = st.selectbox("Strategy", list(BACKTEST_STRATEGIES))
+            # Parameter changes re-run instantly once the prices are loaded
+            backtest_params = {
+                name: st.number_input(name, value=default, step=0.5 if isinstance(default, float) else 1, key=f"{strategy}_{name}")
+                for name, default in BACKTEST_STRATEGIES[strategy].items()
+            }
+            cost_bps = st.number_input("Cost per Trade (bps)", min_value=0.0, value=5.0, step=1.0)
+            sweep = st.checkbox("Sweep Parameters", help="Run every combination of the strategy's parameter grid")
+        else:
+            # Ticker Input
+            ticker = st.text_input(" Enter Ticker Symbol", "", key="ticker_input", help="Example: 'AAPL' for Apple Inc.")
+            company = st.text_input(" Enter Full Company Name", "", key="company_input", help="Example: 'Apple Inc.'")
         
         # Timeframe Selection
         st.subheader("Select Timeframe for Analysis")
@@ -41,21 +202,54 @@ def main():
             help="Select the period of historical data for the stock analysis"
         )
         
-        # Analysis Type Selection
-        st.subheader("Analysis Options")
-        technical_analysis = st.checkbox("Technical Analysis", help="Select to run technical analysis indicators")
-        news_and_events = st.checkbox("News and Events", help="Get recent news and event analysis for the company")
-        fundamental_analysis = st.checkbox("Fundamental Analysis", help="Select to upload a file for fundamental analysis")
-
-        uploaded_file = None
-        if fundamental_analysis:
-            uploaded_file = st.file_uploader("Upload a PDF file for Fundamental Analysis", type="pdf")
+        if mode == "Watchlist":
+            include_ai = st.checkbox("AI Analysis", value=True, help="Run the AI indicator analyses and summary for every ticker")
+            run_button = st.button("Run Watchlist")
+        elif mode == "Screener":
+            run_button = st.button("Run Screener")
+        elif mode == "Backtest":
+            run_button = st.button("Run Backtest")
+        else:
+            # Analysis Type Selection
+            st.subheader("Analysis Options")
+            technical_analysis = st.checkbox("Technical Analysis", key="technical_checkbox", help="Select to run technical analysis indicators")
+            consolidated = False
+            if technical_analysis:
+                consolidated = st.checkbox("Single-call Indicator Analysis", value=INDICATOR_CONSOLIDATED,
+                                           help="Analyze every indicator and write the summary in one AI request "
+                                                "instead of one request each")
+            news_and_events = st.checkbox("News and Events", help="Get recent news and event analysis for the company")
+            fundamental_analysis = st.checkbox("Fundamental Analysis", help="Select to upload a file for fundamental analysis")
+
+            uploaded_file = None
+            if fundamental_analysis:
+                uploaded_file = st.file_uploader("Upload a PDF file for Fundamental Analysis", type="pdf")
         
-        # Run Button with styled alert text
-        run_button = st.button("Run Analysis")
+            # Run Button with styled alert text
+            run_button = st.button("Run Analysis")
         st.markdown("---")
         st.info("Click 'Run Analysis' after selecting options to start.")
 
+        with st.expander("Cache Statistics"):
+            st.write("Price data", price_cache_info())
+            st.write("AI responses", completion_cache_info())
+            st.write("Fundamental reports", filing_cache_info())
+            st.write("OpenAI requests", get_llm_gateway().info())
+            st.write("Coalesced requests", single_flight_info())
+            st.write("Stored analyses", len(stored_analyses()))
+            st.button("Clear Stored Analyses", on_click=invalidate_analysis)
+
+        with st.expander("Precomputed Results"):
+            freshness = get_precompute_store().freshness()
+            if freshness:
+                st.dataframe(pd.DataFrame([
+                    {"Ticker": ticker, "Timeframe": timeframe_name, "News": bool(news),
+                     "Computed": f"{datetime.fromtimestamp(computed_at, MARKET_TZ):%Y-%m-%d %H:%M}"}
+                    for ticker, timeframe_name, news, computed_at in freshness
+                ]), hide_index=True)
+            else:
+                st.write("Nothing precomputed yet. Set PRECOMPUTE_WATCHLIST and run `python Momentum_app_2.py precompute`.")
+
     # Main content section
     st.title("Stock Market Analysis with AI-Powered Insights")
     st.markdown("**Gain actionable insights into stock trends with advanced indicators and AI interpretations.**")
@@ -63,320 +257,306 @@ def main():
     progress_bar = st.progress(0)
     status_text = st.empty()
 
-    if run_button:
-         
-        if timeframe == "1 Month":
-            data = yf.download(ticker, period="1mo")
-        elif timeframe == "3 Months":
-            data = yf.download(ticker, period="3mo")
-        elif timeframe == "6 Months":
-            data = yf.download(ticker, period="6mo")
-        elif timeframe == "1 Year":
-            data = yf.download(ticker, period="1y")  # Check if the "Run" button is pressed
-        
-      
-        
+    if mode == "Watchlist":
+        if run_button:
+            def report(fraction, message):
+                progress_bar.progress(min(100, int(fraction * 100)))
+                status_text.text(message)
+
+            tickers = parse_tickers(watchlist_text)
+            if not tickers:
+                st.warning("Please enter at least one ticker symbol.")
+            else:
+                st.session_state["watchlist_results"] = run_watchlist(tickers, timeframe, include_ai, progress=report)
+                report(1.0, "Analysis complete!")
+        if "watchlist_results" in st.session_state:
+            render_watchlist(st.session_state["watchlist_results"])
+        return
+
+    if mode == "Screener":
+        if run_button:
+            def report(fraction, message):
+                progress_bar.progress(min(100, int(fraction * 100)))
+                status_text.text(message)
+
+            if universe == "S&P 500":
+                names = sp500_constituents()
+            else:
+                names = dict.fromkeys(parse_tickers(screener_text), "")
+            if not names:
+                st.warning("Please enter at least one ticker symbol.")
+            else:
+                st.session_state["screener_results"] = screen_universe(list(names), names, progress=report)
+                report(1.0, "Screening complete!")
+        if "screener_results" in st.session_state:
+            render_screener(st.session_state["screener_results"], int(top_n))
+        return
+
+    if mode == "Backtest":
+        tickers = parse_tickers(backtest_text)
+        key = (tuple(tickers), years, cost_bps)
+        if run_button:
+            if not tickers:
+                st.warning("Please enter at least one ticker symbol.")
+            else:
+                status_text.text(f"Loading {years} years of prices for {len(tickers)} tickers...")
+                st.session_state["backtester"] = (key, load_backtester(tickers, years, cost_bps))
+                status_text.text("Backtest ready.")
+        stored = st.session_state.get("backtester")
+        if stored is not None and stored[0] == key:
+            if stored[1] is None:
+                st.warning("No price data was found for these tickers.")
+            else:
+                render_backtest(stored[1], strategy, backtest_params, sweep)
+        elif stored is not None:
+            st.info("Tickers, history or costs changed; click 'Run Backtest' to load them.")
+        return
+
+    # A job started before a browser refresh is picked up again from the URL
+    job_id = st.experimental_get_query_params().get("job", [None])[0]
+    if job_id and not run_button and not st.session_state.get("rerun_analysis"):
+        follow_analysis_job(job_id, progress_bar, status_text)
+
+    if run_button or st.session_state.pop("rerun_analysis", False):
         if not technical_analysis and not news_and_events and not fundamental_analysis:
             st.warning("Please select at least one analysis type to proceed.")
-        if data.empty:
-            st.warning(f"No data available for {ticker}. Please check the ticker symbol and try again.")
-        if not company:
+        elif not company:
             st.warning(f" Please add Name of company.")
-        elif technical_analysis:
-            with st.expander("Downloading Data"):
-                st.write(f"Analyzing data for the selected timeframe: {timeframe}")
-                st.write("Performing Technical Analysis...")       # Check if data is empty
-                update_progress(progress_bar, 10, 10, "Fetched stock data...")        
-                sma_available = False
-                if 'Close' in data.columns:
-                    data['SMA_20'] = ta.sma(data['Close'], length=20)
-                    data['SMA_50'] = ta.sma(data['Close'], length=50)
-                    data['SMA_200'] = ta.sma(data['Close'], length=200)
-                    if data[['SMA_20', 'SMA_50', 'SMA_200']].notna().any().any():
-                        sma_available = True
-                    else:
-                        update_progress(progress_bar, 30, 30, "SMA is not available...")
-
-                        # Calculate RSI
-                rsi_available = False
-                if 'Close' in data.columns:
-                    data['RSI'] = ta.rsi(data['Close'], length=14)
-                    if 'RSI' in data.columns and data['RSI'].notna().any():
-                        rsi_available = True
-                    else:
-                        update_progress(progress_bar, 30, 30, "RSI is not available...")
-
-                        # Calculate MACD
-                macd_available = False
-                macd = ta.macd(data['Close'])
-                if macd is not None and 'MACD_12_26_9' in macd.columns and 'MACDs_12_26_9' in macd.columns and 'MACDh_12_26_9' in macd.columns:
-                    data['MACD'] = macd['MACD_12_26_9']
-                    data['MACD_signal'] = macd['MACDs_12_26_9']
-                    data['MACD_hist'] = macd['MACDh_12_26_9']
-                    macd_available = True
-                    
-                else:
-                    update_progress(progress_bar, 30, 30, "MACD is not available...")
-
-                        # Calculate OBV
-                obv_available = False
-                if 'Close' in data.columns and 'Volume' in data.columns:
-                    data['OBV'] = ta.obv(data['Close'], data['Volume'])
-                    if 'OBV' in data.columns and data['OBV'].notna().any():
-                        obv_available = True
-                    else:
-                        update_progress(progress_bar, 30, 30, "OBV is not available...")
-
-                        # Calculate ADX
-                adx_available = False
-                adx = ta.adx(data['High'], data['Low'], data['Close'])
-                if adx is not None and 'ADX_14' in adx.columns:
-                    data['ADX'] = adx['ADX_14']
-                    adx_available = True
-                    
-                else:
-                    update_progress(progress_bar, 30, 30, "ADX is not available...")
-
-                        # Calculate Bollinger Bands
-                bbands_available = False
-                bbands = ta.bbands(data['Close'], length=20, std=2)
-                if bbands is not None and 'BBU_20_2.0' in bbands.columns and 'BBM_20_2.0' in bbands.columns and 'BBL_20_2.0' in bbands.columns:
-                    data['upper_band'] = bbands['BBU_20_2.0']
-                    data['middle_band'] = bbands['BBM_20_2.0']
-                    data['lower_band'] = bbands['BBL_20_2.0']
-                    bbands_available = True
-                    
-                else:
-                    update_progress(progress_bar, 30, 30, "Bollinger Bands are not available...")
-                
-                data = data.resample('W').agg({
-                    'Open': 'first',
-                    'High': 'max',
-                    'Low': 'min',
-                    'Close': 'last',
-                    'Volume': 'sum',
-                    'SMA_20': 'last',
-                    'SMA_50': 'last',
-                    'SMA_200': 'last',
-                    'RSI': 'last',
-                    'MACD': 'last',
-                    'MACD_signal': 'last',
-                    'MACD_hist': 'last',
-                    'OBV': 'last',
-                    'ADX': 'last',
-                    'upper_band': 'last',
-                    'middle_band': 'last',
-                    'lower_band': 'last'
-                })
-
-                            # Prepare data for each technical indicator
-                recent_data = data
-                bd_markdown = recent_data[["Open", "High", "Low", "Close", "Volume", "upper_band", "middle_band", "lower_band"]].to_markdown()
-                sma_markdown = recent_data[["Open", "High", "Low", "Close", "SMA_20", "SMA_50", "SMA_200"]].to_markdown()
-                rsi_markdown = recent_data[["Open", "High", "Low", "Close", "RSI"]].to_markdown()
-
-                # If MACD is available, prepare MACD data
-                if macd_available:
-                    macd_markdown = recent_data[["Open", "High", "Low", "Close", "MACD", "MACD_signal", "MACD_hist"]].to_markdown()
-
-                obv_markdown = recent_data[["Open", "High", "Low", "Close", "Volume", "OBV"]].to_markdown()
-                adx_markdown = recent_data[["Open", "High", "Low", "Close", "ADX"]].to_markdown()
-
-
-
-                update_progress(progress_bar, 60, 60, "Preparing data for AI analysis...")
-
-                        # Get analysis from OpenAI
-                update_progress(progress_bar, 65, 65, "Bollinger Bands Analysis...")
-                bd_result = bollingerbands(ticker, bd_markdown)
-                update_progress(progress_bar, 70, 70, "SMA Analysis...")
-                sma_result = SMA(ticker, sma_markdown)
-                update_progress(progress_bar, 75, 75, "RSI Analysis...")
-                rsi_result = RSI(ticker, rsi_markdown)
-                update_progress(progress_bar, 85, 85, "MACD Analysis...")
-                # Only call MACD analysis if MACD data is available
-                if macd_available:
-                    macd_result = MACD(ticker, macd_markdown)
-                else:
-                    macd_result = "MACD analysis not available."  
-                update_progress(progress_bar, 87, 87, "OBV Analysis...")
-                obv_result = OBV(ticker, obv_markdown)
-                update_progress(progress_bar, 90, 90, "ADX Analysis...")
-                adx_result = ADX(ticker, adx_markdown)
-                update_progress(progress_bar, 95, 95, "Analyzing...")
-                # Get summar
-                update_progress(progress_bar, 100, 100, "Analysis complete!")
-
-            if technical_analysis and not news_and_events and not fundamental_analysis:
-                summary = SUMMARY(ticker, bd_result, sma_result, rsi_result, macd_result, obv_result, adx_result)
-                st.subheader(f"Summary for {ticker}")
-                st.write(summary)
-
-                # Use an expander to show detailed analysis for each indicator
-                if bbands_available:
-                    with st.expander("View Detailed Analysis for Bollinger Bands"):
-                        fig_bbands = plot_bbands(data)
-                        st.plotly_chart(fig_bbands)
-                        st.write(bd_result)  # Display Bollinger Bands result or interpretation
-
-                if sma_available:
-                    with st.expander("View Detailed Analysis for SMA"):
-                        fig_sma = plot_sma(data)
-                        st.plotly_chart(fig_sma)
-                        st.write(sma_result)  # Display SMA result or interpretation
-
-                if rsi_available:
-                    with st.expander("View Detailed Analysis for RSI"):
-                        fig_rsi = plot_rsi(data)
-                        st.plotly_chart(fig_rsi)
-                        st.write(rsi_result)  # Display RSI result or interpretation
-
-                if macd_available:
-                    with st.expander("View Detailed Analysis for MACD"):
-                        fig_macd = plot_macd(data)
-                        st.plotly_chart(fig_macd)
-                        st.write(macd_result)  # Display MACD result or interpretation
-
-                if obv_available:
-                    with st.expander("View Detailed Analysis for OBV"):
-                        fig_obv = plot_obv(data)
-                        st.plotly_chart(fig_obv)
-                        st.write(obv_result)  # Display OBV result or interpretation
-
-                if adx_available:
-                    with st.expander("View Detailed Analysis for ADX"):
-                        fig_adx = plot_adx(data)
-                        st.plotly_chart(fig_adx)
-                        st.write(adx_result)  # Display ADX result or interpretation
-
-                if st.button("Run Another Stock"):
-                    analysis_complete = False
-                    st.session_state.technical_analysis = False
-                    st.session_state.news_and_events = False
-                    st.session_state["1_month"] = False
-                    st.session_state["3_months"] = False
-                    st.session_state["6_months"] = False
-                    st.session_state["1_year"] = False
-                    st.experimental_rerun() 
-
-            if news_and_events and not technical_analysis and fundamental_analysis:
-                txt_summary = generate_company_news_message(company, timeframe)
-                txt_summary = format_news(txt_summary)
-                txt_ovr = txt_conclusion(txt_summary,company)
-                        
-                st.subheader(f"News and Events Analysis for {ticker} over the past {timeframe}")
-                st.write(txt_summary)
-                st.write(txt_ovr)
-
-                if st.button("Run Another Stock"):
-                    analysis_complete = False
-                    st.session_state.technical_analysis = False
-                    st.session_state.news_and_events = False
-                    st.session_state["1_month"] = False
-                    st.session_state["3_months"] = False
-                    st.session_state["6_months"] = False
-                    st.session_state["1_year"] = False
-                    st.experimental_rerun()
-
-            if news_and_events and technical_analysis and not fundamental_analysis:
-                summary = SUMMARY(ticker, bd_result, sma_result, rsi_result, macd_result, obv_result, adx_result)
-                txt_summary = generate_company_news_message(company, timeframe)
-                txt_summary = format_news(txt_summary)
-                txt_ovr = txt_conclusion(txt_summary,company)
-                ovr_summary = merge_news_and_technical_analysis_summary(company,txt_summary,summary,timeframe)
-
-                st.subheader(f"News and Events Analysis and Technical Analysis for {ticker} over the past {timeframe}")
-                st.write(txt_summary)
-                st.subheader("Technical Analysis Summary")
-                st.write(summary)
-                st.subheader("Overall Summary")
-                st.write(ovr_summary)
-                st.subheader("Detailed Technical Analysis")
-
-                if bbands_available:
-                    with st.expander("View Detailed Analysis for Bollinger Bands"):
-                        fig_bbands = plot_bbands(data)
-                        st.plotly_chart(fig_bbands)
-                        st.write(bd_result)  # Display Bollinger Bands result or interpretation
-
-                if sma_available:
-                    with st.expander("View Detailed Analysis for SMA"):
-                        fig_sma = plot_sma(data)
-                        st.plotly_chart(fig_sma)
-                        st.write(sma_result)  # Display SMA result or interpretation
-
-                if rsi_available:
-                    with st.expander("View Detailed Analysis for RSI"):
-                        fig_rsi = plot_rsi(data)
-                        st.plotly_chart(fig_rsi)
-                        st.write(rsi_result)  # Display RSI result or interpretation
-
-                if macd_available:
-                    with st.expander("View Detailed Analysis for MACD"):
-                        fig_macd = plot_macd(data)
-                        st.plotly_chart(fig_macd)
-                        st.write(macd_result)  # Display MACD result or interpretation
-
-                if obv_available:
-                    with st.expander("View Detailed Analysis for OBV"):
-                        fig_obv = plot_obv(data)
-                        st.plotly_chart(fig_obv)
-                        st.write(obv_result)  # Display OBV result or interpretation
-
-                if adx_available:
-                    with st.expander("View Detailed Analysis for ADX"):
-                        fig_adx = plot_adx(data)
-                        st.plotly_chart(fig_adx)
-                        st.write(adx_result)  # Display ADX result or interpretation
-
-                if st.button("Run Another Stock"):
-                    analysis_complete = False
-                    st.session_state.technical_analysis = False
-                    st.session_state.news_and_events = False
-                    st.session_state["1_month"] = False
-                    st.session_state["3_months"] = False
-                    st.session_state["6_months"] = False
-                    st.session_state["1_year"] = False
-                    st.experimental_rerun()    
-            if fundamental_analysis and not technical_analysis and not news_and_events: 
-                file_content = uploaded_file
-                file_name = uploaded_file.name
-                fa_summary = FUNDAMENTAL_ANALYSIS(file_content, company, file_name)
-                st.subheader(f"Fundamental Analysis for {ticker} over the past {timeframe}")
-                st.write(fa_summary)
-            
-            if fundamental_analysis and technical_analysis and not news_and_events:
-
-                file_content = uploaded_file
-                file_name = uploaded_file.name
-                fa_summary = FUNDAMENTAL_ANALYSIS(file_content, company, file_name)
-                summary = SUMMARY(ticker, bd_result, sma_result, rsi_result, macd_result, obv_result, adx_result)
-                fa_ta_summary = merge_ta_fa_summary(fa_summary,summary)
-                #st.subheader(f"Fundamental Analysis and Technical Analysis for {ticker} over the past {timeframe}")
-                st.write(fa_ta_summary)
-
-
-            if fundamental_analysis and news_and_events and not news_and_events: 
-                txt_summary = generate_company_news_message(company, timeframe)
-                txt_summary = format_news(txt_summary)
-                txt_ovr = txt_conclusion(txt_summary,company)
-                ovr_summary = merge_news_and_technical_analysis_summary(company,txt_summary,summary,timeframe)
-
-                file_content = uploaded_file
-                file_name = uploaded_file.name
-                fa_summary = FUNDAMENTAL_ANALYSIS(file_content, company, file_name)
-
-                fa_txt_summary = fa_summary_and_news_summary(fa_summary,ovr_summary)
-                st.write(fa_txt_summary)
-
+        elif fundamental_analysis and uploaded_file is None:
+            st.warning("Please upload a PDF file for Fundamental Analysis.")
+        else:
+            key = analysis_key(ticker, company, timeframe, technical_analysis, news_and_events, fundamental_analysis,
+                               uploaded_file, consolidated)
+            st.session_state["current_analysis"] = key
+            force_live = st.session_state.pop("force_live", False)
+            if key not in stored_analyses() and technical_analysis and not fundamental_analysis and not force_live and not consolidated:
+                precomputed = get_precompute_store().get(ticker, timeframe, news_and_events, company)
+                if precomputed is not None:
+                    store_analysis(key, precomputed["result"], stored_at=precomputed["computed_at"], source="precomputed")
+            # Inputs that already have a stored result are redrawn below rather than run again
+            if key in stored_analyses():
+                # A job still in the URL belongs to an earlier run and must not replace this result
+                st.experimental_set_query_params()
+                stored_analyses().move_to_end(key)
+            elif JOB_MODE != "inline":
+                job_id = submit_analysis_job(key, ticker, company, timeframe, technical_analysis, news_and_events,
+                                             fundamental_analysis, uploaded_file, consolidated)
+                st.experimental_set_query_params(job=job_id)
+                follow_analysis_job(job_id, progress_bar, status_text)
+            else:
+                log = st.expander("Downloading Data")
+                view = LiveResultView(ticker, timeframe)
+                with log:
+                    st.write(f"Analyzing data for the selected timeframe: {timeframe}")
+                    result = run_pipeline(
+                        ticker,
+                        company,
+                        timeframe,
+                        technical=technical_analysis,
+                        news=news_and_events,
+                        fundamental=fundamental_analysis,
+                        pdf_file=uploaded_file,
+                        pdf_name=uploaded_file.name if uploaded_file is not None else None,
+                        progress=lambda percent, message: update_progress(progress_bar, percent, percent, message),
+                        on_data=view.show_data,
+                        on_delta=view.write,
+                    )
+                view.finish(result)
+                store_analysis(key, result)
+                analysis_controls(key)
+                return
+
+    # Every other rerun (widget changes, expanders, buttons) redraws the last result from session state
+    key = st.session_state.get("current_analysis")
+    if key in stored_analyses():
+        render_stored_analysis(stored_analyses()[key])
+        analysis_controls(key)
+
+
+def start_deep_dive(ticker, company):
+    # Button callback: switches to single-ticker mode with technical analysis selected and runs it
+    st.session_state["mode"] = "Single Ticker"
+    st.session_state["ticker_input"] = ticker
+    st.session_state["company_input"] = company
+    st.session_state["technical_checkbox"] = True
+    st.session_state["rerun_analysis"] = True
+
+
+def analysis_key(ticker, company, timeframe, technical, news, fundamental, pdf_file=None, consolidated=False):
+    # The PDF is identified by its content, so re-uploading the same report reuses the result
+    pdf_digest = hashlib.sha256(pdf_file.getvalue()).hexdigest() if fundamental and pdf_file is not None else None
+    return (ticker.strip().upper(), company.strip(), timeframe, bool(technical), bool(news), bool(fundamental), pdf_digest,
+            bool(technical and consolidated))
+
+
+def stored_analyses():
+    # Finished AnalysisResults of this browser session by analysis_key, least recently used first
+    return st.session_state.setdefault("analysis_results", OrderedDict())
+
+
+def store_analysis(key, result, stored_at=None, source="live", trace_render=False):
+    # trace_render marks a result whose first draw is timed as part of its run
+    results = stored_analyses()
+    results[key] = {"result": result, "stored_at": stored_at or datetime.now(), "source": source,
+                    "trace_render": trace_render}
+    results.move_to_end(key)
+    while len(results) > SESSION_RESULT_LIMIT:
+        results.popitem(last=False)
+
+
+def invalidate_analysis(key=None):
+    # Drops one stored result, or all of them when no key is given
+    if key is None:
+        stored_analyses().clear()
+    else:
+        stored_analyses().pop(key, None)
+
+
+def refresh_analysis(key):
+    # Button callback: the next run sees no stored result and runs the pipeline again, live
+    invalidate_analysis(key)
+    st.session_state["rerun_analysis"] = True
+    st.session_state["force_live"] = True
+
+
+def render_stored_analysis(entry):
+    result = entry["result"]
+    if entry.get("source") == "precomputed":
+        stored_at = entry["stored_at"]
+        hours = (datetime.now(MARKET_TZ) - stored_at).total_seconds() / 3600
+        st.caption(f"Precomputed {stored_at:%Y-%m-%d %H:%M %Z} ({hours:.1f} hours ago). "
+                   "Use 'Refresh Analysis' for a live run.")
+        if stored_at < datetime.combine(last_completed_session(), MARKET_CLOSE, MARKET_TZ):
+            st.warning("This precomputed result predates the latest market close.")
+    else:
+        st.caption(f"Stored result from {entry['stored_at']:%H:%M:%S}. Use 'Refresh Analysis' to run it again.")
+    view = LiveResultView(result.ticker, result.timeframe)
+    if result.data is not None and entry.pop("trace_render", False) and result.run_id:
+        # A queued job's charts are first drawn here, after its worker exported the run, so their
+        # builds are added to that run. Later redraws on widget reruns are not timed.
+        with resume_run(result.run_id, "render", ticker=result.ticker, timeframe=result.timeframe) as trace:
+            view.show_data(result)
+        result.spans.extend(trace.spans)
+    elif result.data is not None:
+        view.show_data(result)
+    view.finish(result)
+
+
+def analysis_controls(key):
+    left, right = st.columns(2)
+    with left:
+        run_another_stock_button()
+    with right:
+        st.button("Refresh Analysis", on_click=refresh_analysis, args=(key,))
+
+
+# Result sections in display order, keyed by the AnalysisResult field they stream into
+RESULT_SECTIONS = {
+    "ta_summary": "Technical Analysis Summary",
+    "news_summary": "News and Events",
+    "news_conclusion": "News Conclusion",
+    "fa_summary": "Fundamental Analysis",
+    "combined_summary": "Overall Summary",
+}
+
+
+class LiveResultView:
+    """
+    Draws an AnalysisResult while run_pipeline is still producing it.
 
+    Sections are created the first time text streams into them, so each one appears as soon as
+    its own stage starts. Indicator charts are drawn as soon as the weekly data is ready. All
+    methods must be called from the script thread.
+    """
 
+    def __init__(self, ticker, timeframe):
+        st.subheader(f"Analysis for {ticker} over the past {timeframe}")
+        # Stages can finish in any order, so every section gets its slot up front
+        self.section_areas = {stage: st.container() for stage in RESULT_SECTIONS}
+        self.details_area = st.container()
+        self.placeholders = {}
+        self.streamed = {}
+
+    def show_data(self, result):
+        with self.details_area:
+            st.subheader("Detailed Technical Analysis")
+            for label, plot in (("Bollinger Bands", plot_bbands), ("SMA", plot_sma), ("RSI", plot_rsi),
+                                ("MACD", plot_macd), ("OBV", plot_obv), ("ADX", plot_adx)):
+                if result.available.get(label):
+                    with st.expander(f"View Detailed Analysis for {label}"):
+                        with span("chart build", indicator=label):
+                            st.plotly_chart(plot(result.data))
+                        self.placeholders[label] = st.empty()
+
+    def _section(self, stage):
+        if stage not in self.placeholders:
+            with self.section_areas[stage]:
+                st.subheader(RESULT_SECTIONS[stage])
+                self.placeholders[stage] = st.empty()
+        return self.placeholders[stage]
+
+    def write(self, stage, delta):
+        # A None delta means the stage is being regenerated from scratch
+        self.streamed[stage] = "" if delta is None else self.streamed.get(stage, "") + delta
+        # Indicators without enough history have no chart or placeholder, though they are still analyzed
+        if stage not in RESULT_SECTIONS and stage not in self.placeholders:
+            return
+        self._section(stage).markdown(self.streamed[stage] + " ▌")
+
+    def show_text(self, stage, text):
+        # Replaces a stage's text with everything streamed so far, e.g. as polled from a job
+        if text == self.streamed.get(stage) or (stage not in RESULT_SECTIONS and stage not in self.placeholders):
+            return
+        self.streamed[stage] = text
+        self._section(stage).markdown(text + " ▌")
+
+    def finish(self, result):
+        # Replaces streamed text with the final values and adds any section that did not stream
+        for stage in RESULT_SECTIONS:
+            if getattr(result, stage):
+                self._section(stage).markdown(getattr(result, stage))
+        for label, analysis in result.indicator_analyses.items():
+            if label in self.placeholders:
+                self.placeholders[label].markdown(analysis)
+        if result.reused_analyses:
+            with self.details_area:
+                st.caption("Signals unchanged since the last run, previous analysis reused: "
+                           + ", ".join(result.reused_analyses))
+        if result.prompt_tokens:
+            with self.details_area:
+                with st.expander("Prompt Size"):
+                    st.dataframe(pd.DataFrame(result.prompt_tokens), hide_index=True)
+        if result.spans:
+            with self.details_area:
+                with st.expander("Performance"):
+                    total = max(record["duration"] for record in result.spans)
+                    st.caption(f"Run {result.run_id} took {total:.1f} s. Offsets and durations are wall-clock; "
+                               "stages on different threads overlap.")
+                    st.dataframe(span_table(result.spans), hide_index=True, use_container_width=True)
+                    st.caption("Across recent runs")
+                    st.dataframe(span_percentiles(load_spans()), hide_index=True, use_container_width=True)
+        for warning in result.warnings:
+            st.warning(warning)
+
+
+def run_another_stock_button():
+    if st.button("Run Another Stock"):
+        st.session_state.technical_analysis = False
+        st.session_state.news_and_events = False
+        st.session_state["1_month"] = False
+        st.session_state["3_months"] = False
+        st.session_state["6_months"] = False
+        st.session_state["1_year"] = False
+        # The stored result stays available if the same inputs are run again
+        st.session_state.pop("current_analysis", None)
+        st.experimental_set_query_params()
+        st.rerun()
 
 
 def fa_summary_and_news_summary(fa_summary, txt_summary):
 
            
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",  # Ensure that you use a model available in your OpenAI subscription
         messages=[
             {
@@ -433,6 +613,8 @@ def fa_summary_and_news_summary(fa_summary, txt_summary):
         ]
     )
 
+    return response
+
 
 
                 
@@ -445,7 +627,7 @@ def fa_summary_and_news_summary(fa_summary, txt_summary):
 
 def merge_ta_fa_summary(fa_summary,ta_summary):
 
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",  # Ensure that you use a model available in your OpenAI subscription
         messages=[
             {
@@ -502,7 +684,6 @@ def merge_ta_fa_summary(fa_summary,ta_summary):
     )
 
     # Extract and return the AI-generated response
-    response = chat_completion.choices[0].message.content
     return response
 
                         
@@ -515,7 +696,7 @@ def merge_ta_fa_summary(fa_summary,ta_summary):
 
 def txt_conclusion(news_summary,company_name):
     # OpenAI API call to create a merged summary
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",  # Ensure that you use a model available in your OpenAI subscription
         messages=[
             {
@@ -551,7 +732,6 @@ def txt_conclusion(news_summary,company_name):
     )
 
 # Extract and return the AI-generated response
-    response = chat_completion.choices[0].message.content
     return response 
 
     
@@ -569,7 +749,7 @@ def merge_news_and_technical_analysis_summary(company_name, news_summary,technic
     - An overall summary that integrates both the news and technical analysis in a cohesive manner.
     """
     # OpenAI API call to create a merged summary
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",  # Ensure that you use a model available in your OpenAI subscription
         messages=[
             {
@@ -601,57 +781,27 @@ def merge_news_and_technical_analysis_summary(company_name, news_summary,technic
     )
 
     # Extract and return the AI-generated response
-    response = chat_completion.choices[0].message.content
     return response
 
 def generate_company_news_message(company_name, time_period):
-    # Define the messages for different time periods 
-    def post_to_webhook(data):
-        webhook_url = "https://hook.eu2.make.com/s4xsnimg9v87rrrckcwo88d9k57186q6"
-        if webhook_url:
-    
-            response = requests.post(webhook_url,data)
-            return response
-        else:
-            print("Error")
+    # Users asking for the same news at the same time share one webhook job and its wait
+    message, _ = _in_flight.do(("news", company_name, time_period), _company_news_message, company_name, time_period)
+    return message
 
-    data = {"Ticker": company_name, "Time Frame": time_period}
 
+def _company_news_message(company_name, time_period):
+    # The Make.com scenario appends a row for this job ID once its results are ready
+    job_id = new_job_id()
+    data = {"Ticker": company_name, "Time Frame": time_period, "Job ID": job_id}
 
-    response = post_to_webhook(data)
+    response = post_to_webhook(NEWS_WEBHOOK_URL, data)
     print(response.text)
 
-    time.sleep(65)
-
-    scope = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
-
-    credentials_dict = {
-        "type": st.secrets["google_credentials"]["type"],
-        "project_id": st.secrets["google_credentials"]["project_id"],
-        "private_key_id": st.secrets["google_credentials"]["private_key_id"],
-        "private_key": st.secrets["google_credentials"]["private_key"].replace("\\n", "\n"),
-        "client_email": st.secrets["google_credentials"]["client_email"],
-        "client_id": st.secrets["google_credentials"]["client_id"],
-        "auth_uri": st.secrets["google_credentials"]["auth_uri"],
-        "token_uri": st.secrets["google_credentials"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["google_credentials"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["google_credentials"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["google_credentials"]["universe_domain"]
-    }
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, ["https://www.googleapis.com/auth/spreadsheets"])
-
-    gc = gspread.authorize(credentials)
-    #gc = gspread.service_account.from_json_keyfile_name(filename="C:\\Users\\linco\\OneDrive\\Desktop\\Aescap\\Momentum\\stock-momentum-438620-d28ed2443e1a.json")
-    sh = gc.open_by_url("https://docs.google.com/spreadsheets/d/1-cDCZDq8r1rGDVYpY_JhQvb0srhqsIiPhGWaxRC1TPw/edit?usp=sharing")
-    previous = sh.sheet1.get('A2')
-    future = sh.sheet1.get('B2')
+    result = wait_for_job(job_id, get_result_store())
+    previous = result["Previous"]
+    future = result["Future"]
           
-    chats = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             {
@@ -665,12 +815,11 @@ def generate_company_news_message(company_name, time_period):
             },
         ]
     )
-    response = chats.choices[0].message.content
     return response
      
 
 def bollingerbands(company_name, data_text):
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             {
@@ -686,11 +835,10 @@ def bollingerbands(company_name, data_text):
             },
         ]
     )
-    response = chat_completion.choices[0].message.content
     return response
 def SMA(company_name,data_text):
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -718,13 +866,12 @@ def SMA(company_name,data_text):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 
 def RSI(company_name,data_text):
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -751,12 +898,11 @@ def RSI(company_name,data_text):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 def MACD(company_name,data_text):
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -784,13 +930,12 @@ def MACD(company_name,data_text):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 
 def OBV(company_name,data_text):
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -821,13 +966,12 @@ def OBV(company_name,data_text):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 
 def ADX(company_name,data_text):
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -857,55 +1001,25 @@ def ADX(company_name,data_text):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 def FUNDAMENTAL_ANALYSIS(file_name, company_name, file):
 
-    temp_file_path = os.path.join(tempfile.gettempdir(), file)
-
-# Write the contents to the temporary file
-    with open(temp_file_path, 'wb') as temp_file:
-        temp_file.write(file_name.read())
-    
-    message_file = client.files.create(
-    file=open(temp_file_path, "rb"), purpose="assistants"
-    )
-
-    file_id = message_file.id
-
-
-    data = {"File_id": file_id, "Company Name": company_name, "File_name": file}
-
-    webhook_url = "https://hook.eu2.make.com/d68cwl3ujkpqmgrnbpgy9mx3d06vs198"
-    if webhook_url:
-        response = requests.post(webhook_url,data)
-    else: 
-        print("Error")
-
-    time.sleep(65)
-    
-    credentials_dict = {
-        "type": st.secrets["google_credentials"]["type"],
-        "project_id": st.secrets["google_credentials"]["project_id"],
-        "private_key_id": st.secrets["google_credentials"]["private_key_id"],
-        "private_key": st.secrets["google_credentials"]["private_key"].replace("\\n", "\n"),
-        "client_email": st.secrets["google_credentials"]["client_email"],
-        "client_id": st.secrets["google_credentials"]["client_id"],
-        "auth_uri": st.secrets["google_credentials"]["auth_uri"],
-        "token_uri": st.secrets["google_credentials"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["google_credentials"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["google_credentials"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["google_credentials"]["universe_domain"]
-    }
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, ["https://www.googleapis.com/auth/spreadsheets"])
-
-    gc = gspread.authorize(credentials)
-    #gc = gspread.service_account.from_json_keyfile_name(filename="C:\\Users\\linco\\OneDrive\\Desktop\\Aescap\\Momentum\\stock-momentum-438620-d28ed2443e1a.json")
-    sh = gc.open_by_url("https://docs.google.com/spreadsheets/d/1-cDCZDq8r1rGDVYpY_JhQvb0srhqsIiPhGWaxRC1TPw/edit?usp=sharing")
-    anaylsis = sh.sheet1.get('C2')
-
-    chat_completion = client.chat.completions.create(
+    # A report already analyzed for this company is returned straight from the filing cache
+    content_hash = file_sha256(file_name)
+    report = read_filing_analysis(content_hash, company_name)
+    if report is not None:
+        on_delta = getattr(_stream_target, "on_delta", None)
+        if on_delta is not None:
+            on_delta(report)
+        return report
+
+    if FUNDAMENTAL_BACKEND == "webhook":
+        anaylsis = analyze_filing_via_webhook(file_name, company_name, file, content_hash)
+    else:
+        anaylsis = analyze_filing(file_name, company_name)
+
+    response = cached_chat_completion(
         model="gpt-4o",  # Ensure that you use a model available in your OpenAI subscription
         messages=[
             {
@@ -961,14 +1075,174 @@ def FUNDAMENTAL_ANALYSIS(file_name, company_name, file):
         ]
     )
 
+    write_filing_analysis(content_hash, company_name, response)
     # Extract and return the AI-generated response
-    response = chat_completion.choices[0].message.content
     return response 
-    
-   
 
-    
-    
+
+def analyze_filing_via_webhook(pdf_file, company_name, file, content_hash):
+    with upload_on_disk(pdf_file, suffix=".pdf") as path:
+        file_id = openai_file_id(path, file, content_hash)
+
+    # The Make.com scenario appends a row for this job ID once its analysis is ready
+    job_id = new_job_id()
+    data = {"File_id": file_id, "Company Name": company_name, "File_name": file, "Job ID": job_id}
+    post_to_webhook(FA_WEBHOOK_URL, data)
+    return wait_for_job(job_id, get_result_store())["Analysis"]
+
+
+# A page belongs to a financial statement when the statement's title is among its first lines
+FILING_SECTIONS = {
+    "Income Statement": re.compile(
+        r"statements? of (consolidated )?(income|operations|earnings|comprehensive income)|income statements?|profit and loss", re.I),
+    "Balance Sheet": re.compile(r"balance sheets?|statements? of (consolidated )?financial (position|condition)", re.I),
+    "Cash Flow Statement": re.compile(r"statements? of (consolidated )?cash flows?|cash flow statements?", re.I),
+}
+NARRATIVE_SECTION = "Business, Management and Risks"
+
+
+def save_upload(upload, suffix=""):
+    # Copies an uploaded file to a temporary path in 1 MB pieces instead of one read() of the whole file
+    if hasattr(upload, "seek"):
+        upload.seek(0)
+    with tempfile.NamedTemporaryFile("wb", suffix=suffix, delete=False) as temp_file:
+        shutil.copyfileobj(upload, temp_file, 1024 * 1024)
+    return temp_file.name
+
+
+@contextmanager
+def upload_on_disk(upload, suffix=""):
+    # Yields a path holding the upload. A file opened from disk (a queued job's saved copy, or the
+    # CLI's report) is used in place; anything else is copied with save_upload and removed afterwards.
+    if isinstance(upload, io.BufferedReader) and os.path.isfile(upload.name):
+        yield upload.name
+        return
+    path = save_upload(upload, suffix=suffix)
+    try:
+        yield path
+    finally:
+        os.remove(path)
+
+
+def extract_pdf_pages(path):
+    # Yields (page number, text) as each page is parsed, for chunk_filing to consume one at a time
+    for number, page in enumerate(PdfReader(path).pages, start=1):
+        yield number, page.extract_text() or ""
+
+
+def _page_section(text):
+    heading = "\n".join(text.strip().splitlines()[:15])
+    for section, pattern in FILING_SECTIONS.items():
+        if pattern.search(heading):
+            return section
+    return NARRATIVE_SECTION
+
+
+def chunk_filing(pages, max_tokens=FILING_CHUNK_TOKENS):
+    """
+    Groups report pages by section and splits every section into chunks of about max_tokens.
+
+    Parameters:
+    - pages: Iterable of (page number, text).
+    - max_tokens: Token budget per chunk; a single longer page becomes its own chunk.
+
+    Returns:
+    - A list of (section, first page, last page, text), sections in the order they first appear
+      and chunks in document order within each section.
+
+    Pages are added to their section's open chunk as they arrive, so apart from the finished
+    chunks only one open chunk per section is held, not every page's text.
+    """
+    order, open_chunks, chunks = {}, {}, []
+
+    def close(section, pages_in_chunk):
+        chunks.append((section, pages_in_chunk[0][0], pages_in_chunk[-1][0], "\n".join(text for _, text in pages_in_chunk)))
+
+    for number, text in pages:
+        if not text.strip():
+            continue
+        section = _page_section(text)
+        order.setdefault(section, len(order))
+        tokens = count_tokens(text)
+        current, current_tokens = open_chunks.get(section, ([], 0))
+        if current and current_tokens + tokens > max_tokens:
+            close(section, current)
+            current, current_tokens = [], 0
+        current.append((number, text))
+        open_chunks[section] = (current, current_tokens + tokens)
+    for section, (current, _) in open_chunks.items():
+        close(section, current)
+    # Stable, so chunks keep their document order within a section
+    chunks.sort(key=lambda chunk: order[chunk[0]])
+    return chunks
+
+
+def summarize_filing_chunk(company_name, section, first_page, last_page, text):
+    response = cached_chat_completion(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a financial analyst extracting facts from one part of a company's annual report. "
+                    "Write concise bullet points covering every key figure with its period and unit, year-over-year changes, "
+                    "ratios that can be computed from the figures (margins, liquidity, leverage, cash generation), "
+                    "and any notable statements about strategy, competition, management, governance or risks. "
+                    "Only report what the text supports; say so briefly if the part contains nothing material."
+            },
+            {
+                "role": "user",
+                "content": f"Company: {company_name}\nSection: {section} (pages {first_page}-{last_page})\n\n{text}"
+            },
+        ]
+    )
+    return response
+
+
+def analyze_filing(pdf_file, company_name, max_workers=LLM_MAX_WORKERS):
+    """
+    Produces fundamental-analysis notes for an annual report without leaving the process.
+
+    The PDF's text is extracted page by page, from the file itself when it was opened from disk
+    and from a temporary copy otherwise. The pages are split into
+    chunks by section (income statement, balance sheet, cash flow statement, everything else),
+    the chunks are summarized in parallel, and the notes are joined per section. Sections whose
+    notes exceed their share of FILING_NOTES_TOKENS are condensed once more.
+
+    Returns:
+    - The combined notes, in the form FUNDAMENTAL_ANALYSIS formats into the report.
+    """
+    with upload_on_disk(pdf_file, suffix=".pdf") as path:
+        chunks = chunk_filing(extract_pdf_pages(path))
+    if not chunks:
+        raise ValueError("No text could be extracted from the PDF; scanned reports need FUNDAMENTAL_BACKEND=webhook")
+
+    def summarize(chunk):
+        return summarize_filing_chunk(company_name, *chunk)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        summarize = bind_context(summarize)
+        notes = list(executor.map(summarize, chunks))
+
+        by_section = {}
+        for (section, first_page, last_page, _), note in zip(chunks, notes):
+            by_section.setdefault(section, []).append((first_page, last_page, note))
+
+        # Reduce: a section with many chunks is condensed so the final prompt stays within budget
+        share = FILING_NOTES_TOKENS // len(by_section)
+        condensed = {}
+        for section, parts in by_section.items():
+            text = "\n\n".join(note for _, _, note in parts)
+            if len(parts) > 1 and count_tokens(text) > share:
+                condensed[section] = executor.submit(summarize, (section, parts[0][0], parts[-1][1], text))
+            else:
+                condensed[section] = text
+
+    return "\n\n".join(
+        f"## {section}\n\n{text if isinstance(text, str) else text.result()}" for section, text in condensed.items()
+    )
+
+
+
 
 def SUMMARY(company_name,BD,SMA,RSI,MACD,OBV,ADX):
 
@@ -976,7 +1250,7 @@ def SUMMARY(company_name,BD,SMA,RSI,MACD,OBV,ADX):
 
     
     
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -1010,11 +1284,10 @@ def SUMMARY(company_name,BD,SMA,RSI,MACD,OBV,ADX):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 def format_news(txt_summary):
-    chat_completion = client.chat.completions.create(
+    response = cached_chat_completion(
         model="gpt-4o",
         messages=[
             # System message to define the assistant's behavior
@@ -1048,10 +1321,3455 @@ def format_news(txt_summary):
     )
 
 # Output the AI's response
-    response = chat_completion.choices[0].message.content
     return response
 
 
+def get_secret(name, env_var):
+    # st.secrets when a secrets.toml is present, otherwise the environment (headless runs)
+    try:
+        return st.secrets[name]
+    except (KeyError, FileNotFoundError):
+        pass
+    if env_var in os.environ:
+        return os.environ[env_var]
+    raise KeyError(f"'{name}' is missing from st.secrets and the {env_var} environment variable is not set")
+
+
+_openai_client = None
+_sheets_client = None
+_client_lock = threading.Lock()
+
+# Keep-alive connections for the webhook posts, shared by every thread and script run
+_http_session = requests.Session()
+_http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=OPENAI_MAX_CONNECTIONS))
+
+
+def get_openai_client():
+    """
+    Returns the process-wide OpenAI client, creating it on first use so importing this module
+    needs no credentials. Every request shares its keep-alive connection pool.
+    """
+    global _openai_client
+    with _client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI(
+                api_key=get_secret("auth_token", "OPENAI_API_KEY"),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+                # Retries are left to the gateway, which also waits out the rate limits
+                max_retries=0,
+                http_client=DefaultHttpxClient(limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=60.0,
+                )),
+            )
+        return _openai_client
+
+
+def get_sheets_client():
+    """
+    Returns the process-wide gspread client. The service account is authorized once; its
+    session reuses connections and refreshes the access token only when it has expired.
+    """
+    global _sheets_client
+    with _client_lock:
+        if _sheets_client is None:
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(
+                google_credentials_dict(), ["https://www.googleapis.com/auth/spreadsheets"])
+            _sheets_client = gspread.authorize(credentials)
+        return _sheets_client
+
+
+class TokenBucket:
+    """
+    Allows `per_minute` units a minute, refilled continuously, with bursts of up to a minute's
+    worth. A request larger than the bucket may take it below zero, so it delays the ones after it.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        # Seconds until amount can be taken
+        self._refill()
+        needed = min(amount, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+
+_llm_user = threading.local()
+
+
+def set_llm_user(user):
+    # Requests made on this thread are queued as this user's
+    _llm_user.name = user
+
+
+def current_llm_user():
+    return getattr(_llm_user, "name", None) or "default"
+
+
+@contextmanager
+def llm_user(user):
+    previous = getattr(_llm_user, "name", None)
+    _llm_user.name = user
+    try:
+        yield
+    finally:
+        _llm_user.name = previous
+
+
+class RunTrace:
+    """
+    The timing spans of one run, recorded from any of its threads. Each span is a dict with
+    run_id, span_id, parent_id, name, start (epoch seconds), duration (seconds), thread,
+    attributes and error.
+    """
+
+    def __init__(self, name, run_id=None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.name = name
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.spans.append(record)
+
+
+_trace_context = threading.local()
+_trace_log_lock = threading.Lock()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a span of the current run, nested under the enclosing span. Outside a
+    run it records nothing. Yields the span's attributes, which the block may add to.
+    """
+    trace = getattr(_trace_context, "trace", None)
+    if trace is None:
+        yield attributes
+        return
+    parent_id = getattr(_trace_context, "span_id", None)
+    span_id = uuid.uuid4().hex[:8]
+    _trace_context.span_id = span_id
+    start, started = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        _trace_context.span_id = parent_id
+        trace.add({"run_id": trace.run_id, "span_id": span_id, "parent_id": parent_id, "name": name,
+                   "start": start, "duration": time.perf_counter() - started,
+                   "thread": threading.current_thread().name, "attributes": attributes, "error": error})
+
+
+@contextmanager
+def trace_run(name, **attributes):
+    """
+    Records the spans opened inside the block, on this thread or on worker threads started
+    through bind_context, under one run ID, and appends them to TRACE_LOG_PATH at the end.
+    Inside another run it is an ordinary span of that run. Yields the RunTrace.
+    """
+    trace = getattr(_trace_context, "trace", None)
+    if trace is not None:
+        with span(name, **attributes):
+            yield trace
+        return
+    with _exported_run(RunTrace(name), name, attributes) as trace:
+        yield trace
+
+
+@contextmanager
+def resume_run(run_id, name, **attributes):
+    """
+    Records the spans opened inside the block under the ID of a run that was already exported,
+    such as a queued job's pipeline run on a worker, and appends them to TRACE_LOG_PATH at the
+    end. Yields the RunTrace holding only the new spans.
+    """
+    with _exported_run(RunTrace(name, run_id), name, attributes) as trace:
+        yield trace
+
+
+@contextmanager
+def _exported_run(trace, name, attributes):
+    _trace_context.trace = trace
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _trace_context.trace = None
+        export_spans(trace.spans)
+
+
+def export_spans(spans):
+    if not TRACE_LOG_PATH or not spans:
+        return
+    lines = "".join(json.dumps(record, default=str) + "\n" for record in sorted(spans, key=lambda record: record["start"]))
+    # Timings are diagnostics; a full disk or unwritable path must not fail the run
+    try:
+        with _trace_log_lock:
+            if os.path.exists(TRACE_LOG_PATH) and os.path.getsize(TRACE_LOG_PATH) > TRACE_LOG_MAX_BYTES:
+                os.replace(TRACE_LOG_PATH, TRACE_LOG_PATH + ".1")
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as log_file:
+                log_file.write(lines)
+    except OSError:
+        pass
+
+
+def load_spans(path=None, max_bytes=4 * 1024 * 1024):
+    # The spans in the last max_bytes of the JSON lines export, oldest first
+    path = path or TRACE_LOG_PATH
+    try:
+        with open(path, "rb") as log_file:
+            log_file.seek(0, os.SEEK_END)
+            size = log_file.tell()
+            log_file.seek(max(0, size - max_bytes))
+            text = log_file.read().decode("utf-8", errors="replace")
+    except OSError:
+        return []
+    lines = text.splitlines()
+    if size > max_bytes:
+        # The first line is probably cut off
+        lines = lines[1:]
+    spans = []
+    for line in lines:
+        try:
+            spans.append(json.loads(line))
+        except ValueError:
+            continue
+    return spans
+
+
+def span_percentiles(spans):
+    """
+    Aggregates spans by name across runs: count, median, 90th and 99th percentile and maximum
+    duration in milliseconds, and total seconds, largest total first.
+    """
+    frame = pd.DataFrame(spans, columns=["name", "duration"])
+    if frame.empty:
+        return pd.DataFrame(columns=["span", "count", "p50_ms", "p90_ms", "p99_ms", "max_ms", "total_s"])
+    durations = frame.groupby("name")["duration"]
+    table = pd.DataFrame({
+        "count": durations.size(),
+        "p50_ms": durations.quantile(0.5) * 1000,
+        "p90_ms": durations.quantile(0.9) * 1000,
+        "p99_ms": durations.quantile(0.99) * 1000,
+        "max_ms": durations.max() * 1000,
+        "total_s": durations.sum(),
+    })
+    table = table.sort_values("total_s", ascending=False).round(1).assign(total_s=table["total_s"].round(2))
+    return table.rename_axis("span").reset_index()
+
+
+def span_table(spans):
+    # One row per span, parents before their children and siblings in start order
+    ids = {record["span_id"] for record in spans}
+    children = {}
+    for record in sorted(spans, key=lambda record: record["start"]):
+        parent_id = record["parent_id"] if record["parent_id"] in ids else None
+        children.setdefault(parent_id, []).append(record)
+    run_start = min((record["start"] for record in spans), default=0)
+    rows = []
+
+    def visit(parent_id, depth):
+        for record in children.get(parent_id, []):
+            rows.append({
+                "span": "· " * depth + record["name"],
+                "start_ms": round((record["start"] - run_start) * 1000),
+                "duration_ms": round(record["duration"] * 1000, 1),
+                "thread": record["thread"],
+                "details": ", ".join(f"{name}={value}" for name, value in record["attributes"].items()),
+                "error": record["error"] or "",
+            })
+            visit(record["span_id"], depth + 1)
+
+    visit(None, 0)
+    return pd.DataFrame(rows)
+
+
+_cancel_context = threading.local()
+
+
+@contextmanager
+def cancellable(check):
+    # Long waits and OpenAI requests made inside the block call check() first; it raises to stop them
+    previous = getattr(_cancel_context, "check", None)
+    _cancel_context.check = check
+    try:
+        yield
+    finally:
+        _cancel_context.check = previous
+
+
+def check_cancelled():
+    check = getattr(_cancel_context, "check", None)
+    if check is not None:
+        check()
+
+
+def bind_context(function):
+    # Wraps function so that, run on a worker thread, its requests still count as the caller's,
+    # its spans nest under the caller's current span and the caller's cancellation applies
+    user = current_llm_user()
+    trace = getattr(_trace_context, "trace", None)
+    parent_id = getattr(_trace_context, "span_id", None)
+    check = getattr(_cancel_context, "check", None)
+
+    def bound(*args, **kwargs):
+        previous = (getattr(_trace_context, "trace", None), getattr(_trace_context, "span_id", None))
+        _trace_context.trace, _trace_context.span_id = trace, parent_id
+        try:
+            with llm_user(user), cancellable(check):
+                return function(*args, **kwargs)
+        finally:
+            _trace_context.trace, _trace_context.span_id = previous
+    return bound
+
+
+def session_user():
+    # The browser session running this script, or None outside Streamlit
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+
+def retry_delay(exc, attempt):
+    """
+    Returns how long to wait before retrying after exc, or None if it should not be retried.
+    429s honour a Retry-After header; otherwise the wait is drawn uniformly up to an exponentially
+    growing cap, so clients that failed together do not retry together.
+    """
+    if isinstance(exc, APIStatusError):
+        if exc.status_code not in (408, 409, 429) and exc.status_code < 500:
+            return None
+        retry_after = exc.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(OPENAI_BACKOFF_MAX, float(retry_after))
+            except ValueError:
+                pass
+    elif not isinstance(exc, APIConnectionError):
+        return None
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+
+class LLMGateway:
+    """
+    Admits OpenAI requests from every thread and session in the process.
+
+    Waiting requests are queued per user and admitted round-robin, one per user in turn, when
+    both the requests-per-minute and tokens-per-minute buckets have room. A user starting a
+    watchlist of hundreds of requests therefore delays another user's single analysis by at
+    most one request per turn.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM, max_retries=OPENAI_MAX_RETRIES):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.waiting = {}
+        self.turns = deque()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "throttled": 0,
+                      "queue_wait_total": 0.0, "queue_wait_max": 0.0, "waiting": 0, "errors": {}}
+
+    def _admit(self, tokens):
+        """
+        Blocks until it is this thread's turn and the buckets have room; returns the seconds waited.
+        Inside a cancellable block the cancel check runs every JOB_POLL_INTERVAL while waiting, and
+        a cancelled request gives up its place in the queue.
+        """
+        user = current_llm_user()
+        ticket = object()
+        started = time.monotonic()
+        throttled = False
+        poll = JOB_POLL_INTERVAL if getattr(_cancel_context, "check", None) is not None else None
+        with self.condition:
+            if user not in self.waiting:
+                self.waiting[user] = deque()
+                self.turns.append(user)
+            self.waiting[user].append(ticket)
+            self.stats["waiting"] += 1
+            try:
+                while True:
+                    if self.waiting[self.turns[0]][0] is ticket:
+                        delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+                        if delay <= 0:
+                            break
+                        throttled = True
+                        self.condition.wait(delay if poll is None else min(delay, poll))
+                    else:
+                        self.condition.wait(poll)
+                    if poll is not None:
+                        # The check may query the job store, so other threads are not held up meanwhile
+                        self.condition.release()
+                        try:
+                            check_cancelled()
+                        finally:
+                            self.condition.acquire()
+            except BaseException:
+                self.waiting[user].remove(ticket)
+                if not self.waiting[user]:
+                    del self.waiting[user]
+                    self.turns.remove(user)
+                self.stats["waiting"] -= 1
+                self.condition.notify_all()
+                raise
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            # The user goes to the back of the line, behind everyone else waiting
+            self.turns.popleft()
+            self.waiting[user].popleft()
+            if self.waiting[user]:
+                self.turns.append(user)
+            else:
+                del self.waiting[user]
+            waited = time.monotonic() - started
+            self.stats["waiting"] -= 1
+            self.stats["requests"] += 1
+            self.stats["throttled"] += throttled
+            self.stats["queue_wait_total"] += waited
+            self.stats["queue_wait_max"] = max(self.stats["queue_wait_max"], waited)
+            self.condition.notify_all()
+        return waited
+
+    def call(self, request, tokens=0):
+        """
+        Runs request() once admitted, retrying transient failures.
+
+        Parameters:
+        - request: Callable making one OpenAI API call; it is called again for each retry.
+        - tokens: Estimated prompt plus completion tokens, charged to the tokens-per-minute bucket.
+
+        Returns:
+        - Whatever request() returns.
+        """
+        for attempt in range(self.max_retries + 1):
+            check_cancelled()
+            with span("llm queue", attempt=attempt, tokens=tokens):
+                self._admit(tokens)
+            try:
+                with span("openai request", attempt=attempt):
+                    return request()
+            except Exception as exc:
+                delay = retry_delay(exc, attempt)
+                name = getattr(exc, "status_code", None) or type(exc).__name__
+                with self.condition:
+                    self.stats["errors"][name] = self.stats["errors"].get(name, 0) + 1
+                    if delay is None or attempt == self.max_retries:
+                        self.stats["failures"] += 1
+                        raise
+                    self.stats["retries"] += 1
+            with span("llm backoff", attempt=attempt, error=name):
+                time.sleep(delay)
+
+    def settle(self, estimated, actual):
+        # Corrects the token bucket once a response reports the tokens it really used
+        with self.condition:
+            self.tokens.take(actual - estimated)
+
+    def info(self):
+        with self.condition:
+            stats = dict(self.stats, errors=dict(self.stats["errors"]))
+            stats["requests_available"] = round(max(0.0, self.requests.level), 1)
+            stats["tokens_available"] = round(max(0.0, self.tokens.level))
+        stats["queue_wait_mean"] = stats["queue_wait_total"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+
+_llm_gateway = None
+
+
+def get_llm_gateway():
+    global _llm_gateway
+    with _client_lock:
+        if _llm_gateway is None:
+            _llm_gateway = LLMGateway()
+        return _llm_gateway
+
+
+def estimate_request_tokens(messages, params):
+    return count_tokens(json.dumps(messages)) + params.get("max_tokens", OPENAI_COMPLETION_ESTIMATE)
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time across every thread and session in the process.
+    A caller whose key is already in flight waits for that call and shares its result, or its
+    exception, instead of starting a duplicate.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"calls": 0, "coalesced": 0, "in_flight": 0}
+
+    def do(self, key, function, *args):
+        """
+        Returns (result of function(*args), shared), where shared is True when the result came
+        from a call another caller had already started.
+        """
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                    self.stats["calls"] += 1
+                else:
+                    self.stats["coalesced"] += 1
+            if leader:
+                break
+            call["done"].wait()
+            # The call was abandoned because its caller's job was cancelled; this caller runs it instead
+            if isinstance(call["error"], JobCancelled):
+                continue
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+
+        try:
+            call["result"] = function(*args)
+        except BaseException as exc:
+            call["error"] = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+        return call["result"], False
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.calls))
+
+
+# Identical price fetches, news jobs and chat completions running at the same time share one call
+_in_flight = SingleFlight()
+
+
+def single_flight_info():
+    return _in_flight.info()
+
+
+_completion_lock = threading.Lock()
+completion_cache_stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+
+
+def completion_cache_key(model, messages, **params):
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _completion_path(key):
+    return os.path.join(COMPLETION_CACHE_DIR, f"{key}.json")
+
+
+def _read_cached_completion(key):
+    return _read_cache_file(_completion_path(key), COMPLETION_CACHE_TTL)
+
+
+def _write_cached_completion(key, entry):
+    _write_cache_file(COMPLETION_CACHE_DIR, _completion_path(key), entry)
+    _evict_cache_files(COMPLETION_CACHE_DIR, COMPLETION_CACHE_MAX_BYTES)
+
+
+def _read_cache_file(path, ttl):
+    # Returns the JSON entry at path, or None when it is missing, unreadable or older than ttl
+    try:
+        with open(path, encoding="utf-8") as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["created"] > ttl:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    # Reads bump the modification time, which is what LRU eviction orders by
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entry
+
+
+def _write_cache_file(directory, path, entry):
+    os.makedirs(directory, exist_ok=True)
+    temp_path = path + f".{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as cache_file:
+        json.dump(entry, cache_file)
+    os.replace(temp_path, path)
+
+
+def _evict_cache_files(directory, max_bytes):
+    # Drop least recently used entries until the directory fits in max_bytes
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".json"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+_stream_target = threading.local()
+
+
+@contextmanager
+def stream_to(on_delta):
+    # Chat completions made on this thread inside the block stream their text to on_delta
+    previous = getattr(_stream_target, "on_delta", None)
+    _stream_target.on_delta = on_delta
+    try:
+        yield
+    finally:
+        _stream_target.on_delta = previous
+
+
+def call_streaming(on_delta, function, *args):
+    # Runs function(*args) with its chat completions streamed to on_delta; used to stream from worker threads
+    with stream_to(on_delta):
+        return function(*args)
+
+
+def _stream_chat_completion(model, messages, on_delta, **params):
+    # Returns (content, refusal, finish_reason), read from the stream as a plain response would carry them
+    parts = []
+
+    def request():
+        # A stream that breaks off is retried from the start, so text already passed on is withdrawn
+        if parts:
+            parts.clear()
+            on_delta(None)
+        refusal, finish_reason = [], None
+        for chunk in get_openai_client().chat.completions.create(model=model, messages=messages, stream=True, **params):
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                parts.append(choice.delta.content)
+                on_delta(parts[-1])
+            if getattr(choice.delta, "refusal", None):
+                refusal.append(choice.delta.refusal)
+            finish_reason = choice.finish_reason or finish_reason
+        return "".join(parts), "".join(refusal) or None, finish_reason
+
+    return get_llm_gateway().call(request, tokens=estimate_request_tokens(messages, params))
+
+
+def cached_chat_completion(model, messages, **params):
+    """
+    Sends a chat completion request, answering repeats of an identical request from the disk cache.
+
+    Inside a stream_to() block the response is streamed and each piece of text is passed to the
+    callback as it arrives; a cached response is passed in one piece.
+
+    Parameters:
+    - model, messages, **params: Passed through to client.chat.completions.create.
+
+    Returns:
+    - The text of the first choice.
+    """
+    with span("llm call", model=model) as attributes:
+        on_delta = getattr(_stream_target, "on_delta", None)
+        key = completion_cache_key(model, messages, **params)
+        entry = _read_cached_completion(key) if _completion_log is None else None
+        if entry is not None:
+            attributes["source"] = "cache"
+            with _completion_lock:
+                completion_cache_stats["hits"] += 1
+                completion_cache_stats["bytes_saved"] += entry["bytes"]
+            if on_delta is not None:
+                on_delta(entry["content"])
+            return entry["content"]
+
+        # A request identical to one still in flight for another user waits for it instead of repeating it
+        content, shared = _in_flight.do(("completion", key), _request_completion, key, model, messages, on_delta, params)
+        attributes["source"] = "shared" if shared else "openai"
+        if shared and on_delta is not None:
+            on_delta(content)
+        return content
+
+
+def evict_cached_completion(model, messages, **params):
+    # Drops a cached response the caller found unusable, so the next identical request asks again
+    try:
+        os.remove(_completion_path(completion_cache_key(model, messages, **params)))
+    except OSError:
+        pass
+
+
+def _request_completion(key, model, messages, on_delta, params):
+    with _completion_lock:
+        completion_cache_stats["misses"] += 1
+    started = time.perf_counter()
+    usage = None
+    if on_delta is None:
+        gateway = get_llm_gateway()
+        estimated = estimate_request_tokens(messages, params)
+        chat_completion = gateway.call(
+            lambda: get_openai_client().chat.completions.create(model=model, messages=messages, **params),
+            tokens=estimated)
+        usage = chat_completion.usage
+        if usage is not None:
+            gateway.settle(estimated, usage.total_tokens)
+        choice = chat_completion.choices[0]
+        content, refusal, finish_reason = choice.message.content, getattr(choice.message, "refusal", None), choice.finish_reason
+    else:
+        content, refusal, finish_reason = _stream_chat_completion(model, messages, on_delta, **params)
+    # A structured-output refusal comes back with no content; neither it nor an empty response is cached
+    if refusal or not content:
+        raise ValueError(f"The model returned no content: {refusal or finish_reason}")
+    complete = finish_reason != "length"
+    if _completion_log is not None:
+        _completion_log.append({
+            "seconds": time.perf_counter() - started,
+            "prompt_tokens": usage.prompt_tokens if usage else count_tokens(json.dumps(messages)),
+            "completion_tokens": usage.completion_tokens if usage else count_tokens(content),
+        })
+    # A response cut off at the token limit is returned but not replayed from the cache
+    if not complete:
+        return content
+    request_bytes = len(json.dumps(messages).encode("utf-8"))
+    _write_cached_completion(key, {
+        "created": time.time(),
+        "model": model,
+        "content": content,
+        "bytes": request_bytes + len(content.encode("utf-8")),
+    })
+    return content
+
+
+_completion_log = None
+
+
+@contextmanager
+def record_completions():
+    """
+    Skips the completion cache and records the latency and token counts of every completion
+    requested inside the block, on any thread. Affects the whole process; meant for benchmarks.
+    """
+    global _completion_log
+    _completion_log = []
+    try:
+        yield _completion_log
+    finally:
+        _completion_log = None
+
+
+def completion_cache_info():
+    with _completion_lock:
+        return dict(completion_cache_stats)
+
+
+_filing_lock = threading.Lock()
+filing_cache_stats = {"hits": 0, "misses": 0, "uploads_reused": 0}
+
+
+def file_sha256(upload):
+    # Hashes a binary file object in 1 MB pieces and rewinds it for the next reader
+    digest = hashlib.sha256()
+    upload.seek(0)
+    for block in iter(lambda: upload.read(1024 * 1024), b""):
+        digest.update(block)
+    upload.seek(0)
+    return digest.hexdigest()
+
+
+def _filing_path(content_hash, name):
+    return os.path.join(FILING_CACHE_DIR, f"{content_hash}.{name}.json")
+
+
+def _company_key(company_name):
+    return hashlib.sha256(" ".join(company_name.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+
+def read_filing_analysis(content_hash, company_name):
+    entry = _read_cache_file(_filing_path(content_hash, _company_key(company_name)), FILING_CACHE_TTL)
+    with _filing_lock:
+        filing_cache_stats["hits" if entry is not None else "misses"] += 1
+    return None if entry is None else entry["report"]
+
+
+def write_filing_analysis(content_hash, company_name, report):
+    _write_cache_file(FILING_CACHE_DIR, _filing_path(content_hash, _company_key(company_name)),
+                      {"created": time.time(), "company": company_name, "report": report})
+    _evict_cache_files(FILING_CACHE_DIR, FILING_CACHE_MAX_BYTES)
+
+
+def openai_file_id(path, file_name, content_hash):
+    """
+    Uploads the file at path to OpenAI once per content hash. Later calls with the same content
+    reuse the stored file ID, as long as OpenAI still has the file.
+    """
+    upload_path = _filing_path(content_hash, "upload")
+    entry = _read_cache_file(upload_path, FILING_CACHE_TTL)
+    if entry is not None:
+        try:
+            get_llm_gateway().call(lambda: get_openai_client().files.retrieve(entry["file_id"]))
+            with _filing_lock:
+                filing_cache_stats["uploads_reused"] += 1
+            return entry["file_id"]
+        except NotFoundError:
+            pass
+
+    def upload():
+        with open(path, "rb") as upload_file:
+            return get_openai_client().files.create(file=(file_name, upload_file), purpose="assistants")
+
+    message_file = get_llm_gateway().call(upload)
+    _write_cache_file(FILING_CACHE_DIR, upload_path, {"created": time.time(), "file_id": message_file.id})
+    return message_file.id
+
+
+def filing_cache_info():
+    with _filing_lock:
+        return dict(filing_cache_stats)
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def post_to_webhook(webhook_url, data):
+    with span("webhook post"):
+        response = _http_session.post(webhook_url, data, timeout=30)
+    response.raise_for_status()
+    return response
+
+
+def google_credentials_dict():
+    google_credentials = get_secret("google_credentials", "GOOGLE_CREDENTIALS")
+    if isinstance(google_credentials, str):
+        google_credentials = json.loads(google_credentials)
+    credentials_dict = {
+        "type": google_credentials["type"],
+        "project_id": google_credentials["project_id"],
+        "private_key_id": google_credentials["private_key_id"],
+        "private_key": google_credentials["private_key"].replace("\\n", "\n"),
+        "client_email": google_credentials["client_email"],
+        "client_id": google_credentials["client_id"],
+        "auth_uri": google_credentials["auth_uri"],
+        "token_uri": google_credentials["token_uri"],
+        "auth_provider_x509_cert_url": google_credentials["auth_provider_x509_cert_url"],
+        "client_x509_cert_url": google_credentials["client_x509_cert_url"],
+        "universe_domain": google_credentials["universe_domain"]
+    }
+    return credentials_dict
+
+
+def open_results_sheet():
+    return get_sheets_client().open_by_url(RESULTS_SHEET_URL)
+
+
+RESULT_FIELDS = ["Job ID", "Kind", "Previous", "Future", "Analysis", "Completed At"]
+
+
+class SheetResultStore:
+    """
+    Job results kept in a worksheet with one row per job, laid out as RESULT_FIELDS.
+    "Completed At" is an ISO timestamp written by the scenario.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def get(self, job_id, attempts=3):
+        # Cleanup in this or another process can shift rows between find() and row_values(), so
+        # the row read must still carry the job ID; otherwise it is located again
+        with span("sheet read"):
+            for _ in range(attempts):
+                cell = self.worksheet.find(job_id, in_column=1)
+                if cell is None:
+                    return None
+                values = self.worksheet.row_values(cell.row)
+                if values and values[0] == job_id:
+                    values += [""] * (len(RESULT_FIELDS) - len(values))
+                    return dict(zip(RESULT_FIELDS, values))
+        return None
+
+    def put(self, job_id, kind, previous="", future="", analysis=""):
+        completed_at = datetime.now(timezone.utc).isoformat()
+        self.worksheet.append_row([job_id, kind, previous, future, analysis, completed_at])
+
+    def cleanup(self, max_age=RESULT_RETENTION):
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age)
+        rows = self.worksheet.get_all_values()
+        expired = []
+        for row in rows[1:]:
+            try:
+                completed_at = datetime.fromisoformat(row[5])
+            except (IndexError, ValueError):
+                continue
+            if completed_at.tzinfo is None:
+                completed_at = completed_at.replace(tzinfo=timezone.utc)
+            if completed_at < cutoff and row[0]:
+                expired.append(row[0])
+        if not expired:
+            return 0
+        # Other processes may delete or append rows meanwhile, so the expired rows are located by
+        # job ID in a fresh read of the ID column, then deleted in one request. Bottom rows go
+        # first so each deletion leaves the row numbers of the ones still to come unchanged.
+        expired = set(expired)
+        rows = [number for number, job_id in enumerate(self.worksheet.col_values(1), start=1) if job_id in expired]
+        if not rows:
+            return 0
+        self.worksheet.spreadsheet.batch_update({"requests": [
+            {"deleteDimension": {"range": {"sheetId": self.worksheet.id, "dimension": "ROWS",
+                                           "startIndex": number - 1, "endIndex": number}}}
+            for number in sorted(rows, reverse=True)
+        ]})
+        return len(rows)
+
+
+class SQLiteResultStore:
+    """
+    Local stand-in for SheetResultStore backed by a SQLite file, safe to share between threads.
+    """
+
+    def __init__(self, path=RESULT_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_results ("
+                "job_id TEXT PRIMARY KEY, kind TEXT, previous TEXT, future TEXT, analysis TEXT, completed_at REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT job_id, kind, previous, future, analysis, completed_at FROM job_results WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(RESULT_FIELDS, row))
+
+    def put(self, job_id, kind, previous="", future="", analysis=""):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_results VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, previous, future, analysis, time.time()),
+            )
+
+    def cleanup(self, max_age=RESULT_RETENTION):
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM job_results WHERE completed_at < ?", (time.time() - max_age,))
+        return cursor.rowcount
+
+
+_result_store = None
+_result_store_lock = threading.Lock()
+_last_result_cleanup = 0.0
+
+
+def get_result_store():
+    # The store, and for the sheet its spreadsheet and worksheet handles, is opened once per process
+    global _result_store, _last_result_cleanup
+
+    with _result_store_lock:
+        if _result_store is None:
+            if RESULT_STORE == "sqlite":
+                _result_store = SQLiteResultStore()
+            else:
+                _result_store = SheetResultStore(open_results_sheet().worksheet(RESULTS_WORKSHEET))
+        store = _result_store
+
+        # Expired rows are pruned at most once an hour, on a thread of their own so the request
+        # that happens to be first in the hour does not wait for the sheet calls
+        cleanup_due = time.time() - _last_result_cleanup > 3600
+        if cleanup_due:
+            _last_result_cleanup = time.time()
+    if cleanup_due:
+        threading.Thread(target=store.cleanup, name="result-cleanup", daemon=True).start()
+    return store
+
+
+def wait_for_job(job_id, store, timeout=None, initial_delay=2.0, max_delay=15.0):
+    """
+    Polls the result store until the row for the given job appears.
+
+    Parameters:
+    - job_id: The ID sent with the webhook payload.
+    - store: A SheetResultStore or SQLiteResultStore.
+    - timeout: Seconds to wait before raising TimeoutError (defaults to WEBHOOK_TIMEOUT).
+    - initial_delay, max_delay: Bounds of the exponential backoff between polls.
+
+    Returns:
+    - The job's result row as a dict keyed by RESULT_FIELDS.
+    """
+    if timeout is None:
+        timeout = WEBHOOK_TIMEOUT
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    with span("webhook wait", job_id=job_id) as attributes:
+        attributes["polls"] = 0
+        while True:
+            check_cancelled()
+            attributes["polls"] += 1
+            result = store.get(job_id)
+            if result is not None:
+                return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Job {job_id} did not finish within {timeout:g} seconds")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+
+# Calendar days covered by each yfinance period string
+PERIOD_DAYS = {"1mo": 31, "3mo": 92, "6mo": 183, "1y": 366, "2y": 731, "5y": 1827, "10y": 3653}
+
+_price_memory = OrderedDict()
+_price_lock = threading.Lock()
+price_cache_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "incremental_fetches": 0}
+
+
+class MarketHolidayCalendar(AbstractHolidayCalendar):
+    # Full-day NYSE closures. Early-close days still produce a daily bar, so they are not listed.
+    rules = [
+        # A New Year's Day on Saturday is not made up on the Friday before
+        Holiday("New Year's Day", month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday("Juneteenth", month=6, day=19, start_date="2022-01-01", observance=nearest_workday),
+        Holiday("Independence Day", month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday("Christmas Day", month=12, day=25, observance=nearest_workday),
+    ]
+
+
+MARKET_HOLIDAYS = frozenset(MarketHolidayCalendar().holidays(start="1990-01-01", end="2099-12-31").date)
+
+
+def last_completed_session(now=None):
+    # Date of the most recent trading session whose close has passed. Unscheduled closures are not
+    # known, so the first request after one downloads once and finds no new bar.
+    now = now or datetime.now(MARKET_TZ)
+    day = now.date()
+    if now.time() < MARKET_CLOSE:
+        day -= timedelta(days=1)
+    while day.weekday() >= 5 or day in MARKET_HOLIDAYS:
+        day -= timedelta(days=1)
+    return day
+
+
+def _completed_bars(data, session):
+    # The price cache holds closed sessions only. A bar for a session still trading is dropped, so a
+    # cold download and a cache hit return the same bars until the close.
+    return data.loc[data.index <= pd.Timestamp(session)]
+
+
+def _download_prices(ticker, **kwargs):
+    with span("yfinance download", ticker=ticker, **kwargs):
+        data = yf.download(ticker, progress=False, **kwargs)
+    # Newer yfinance releases return (field, ticker) columns even for a single symbol
+    if isinstance(data.columns, pd.MultiIndex):
+        data.columns = data.columns.get_level_values(0)
+    return data
+
+
+def _price_file(ticker, extension):
+    return os.path.join(PRICE_CACHE_DIR, f"{ticker}.{extension}")
+
+
+def _load_price_entry(ticker):
+    # Bars live in <ticker>.parquet, the last session checked against yfinance in <ticker>.json
+    try:
+        data = pd.read_parquet(_price_file(ticker, "parquet"))
+        with open(_price_file(ticker, "json")) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    if data.empty:
+        return None
+    covered_from = meta.get("covered_from")
+    return {"data": data, "checked_through": datetime.fromisoformat(meta["checked_through"]).date(),
+            "covered_from": pd.Timestamp(covered_from) if covered_from else None}
+
+
+def _save_price_entry(ticker, entry):
+    os.makedirs(PRICE_CACHE_DIR, exist_ok=True)
+    # Write to temporary names first so readers never see a partial file
+    suffix = f".{uuid.uuid4().hex}.tmp"
+    entry["data"].to_parquet(_price_file(ticker, "parquet") + suffix)
+    with open(_price_file(ticker, "json") + suffix, "w") as meta_file:
+        covered_from = entry.get("covered_from")
+        json.dump({"checked_through": entry["checked_through"].isoformat(),
+                   "covered_from": covered_from.isoformat() if covered_from is not None else None}, meta_file)
+    os.replace(_price_file(ticker, "parquet") + suffix, _price_file(ticker, "parquet"))
+    os.replace(_price_file(ticker, "json") + suffix, _price_file(ticker, "json"))
+
+
+def _count_price_cache(counter):
+    with _price_lock:
+        price_cache_stats[counter] += 1
+
+
+def _lookup_price_entry(ticker):
+    with _price_lock:
+        entry = _price_memory.get(ticker)
+        if entry is not None:
+            _price_memory.move_to_end(ticker)
+            return entry, "memory_hits"
+    return _load_price_entry(ticker), "disk_hits"
+
+
+def _remember_price_entry(ticker, entry):
+    with _price_lock:
+        _price_memory[ticker] = entry
+        _price_memory.move_to_end(ticker)
+        while len(_price_memory) > PRICE_CACHE_SIZE:
+            _price_memory.popitem(last=False)
+
+
+def _period_start(period):
+    return pd.Timestamp(datetime.now(MARKET_TZ).date() - timedelta(days=PERIOD_DAYS[period]))
+
+
+def _covers(entry, start):
+    # Stored history must reach back to the requested start, allowing for weekends and holidays.
+    # A ticker listed after the start is covered once a full download from that start was stored
+    if entry is None:
+        return False
+    if entry["data"].index[0] <= start + timedelta(days=7):
+        return True
+    covered_from = entry.get("covered_from")
+    return covered_from is not None and covered_from <= start
+
+
+def _store_full_download(ticker, data, previous, session, start):
+    # A full download returns everything yfinance has from start on, however late the listing
+    covered_from = start
+    if previous is not None:
+        data = data.combine_first(previous["data"])
+        if previous.get("covered_from") is not None:
+            covered_from = min(covered_from, previous["covered_from"])
+    entry = {"data": data, "checked_through": session, "covered_from": covered_from}
+    _save_price_entry(ticker, entry)
+    _remember_price_entry(ticker, entry)
+    return entry
+
+
+def get_price_history(ticker, period="1y"):
+    """
+    Returns daily OHLCV bars for the ticker covering the given yfinance period.
+
+    Bars come from an in-memory LRU, then the on-disk parquet store, and only bars newer than
+    the last stored date are downloaded. Nothing is re-fetched once the latest completed session
+    has been checked, so repeat requests after the close, over a weekend or on a market holiday
+    cost no network. Today's bar appears only once its session has closed.
+    """
+    ticker = ticker.strip().upper()
+    # Concurrent requests for the same ticker wait for one fetch; each gets its own copy of the bars
+    data, _ = _in_flight.do(("prices", ticker, period), _refresh_price_history, ticker, period)
+    if data.empty:
+        return data.copy()
+    return data.loc[data.index >= _period_start(period)].copy()
+
+
+def _refresh_price_history(ticker, period):
+    # Returns every stored bar for the ticker once its history covers the period and is up to date
+    start = _period_start(period)
+    session = last_completed_session()
+    entry, source = _lookup_price_entry(ticker)
+
+    if _covers(entry, start) and entry["checked_through"] >= session:
+        _count_price_cache(source)
+        _remember_price_entry(ticker, entry)
+    elif _covers(entry, start):
+        # Refetch from the last stored bar so one stored before its session closed is replaced by its final values
+        _count_price_cache("incremental_fetches")
+        last_date = entry["data"].index[-1]
+        new_bars = _completed_bars(_download_prices(ticker, start=last_date.strftime("%Y-%m-%d")), session)
+        data = pd.concat([entry["data"], new_bars])
+        entry = {"data": data[~data.index.duplicated(keep="last")], "checked_through": session,
+                 "covered_from": entry.get("covered_from")}
+        _save_price_entry(ticker, entry)
+        _remember_price_entry(ticker, entry)
+    else:
+        _count_price_cache("misses")
+        data = _completed_bars(_download_prices(ticker, period=period), session)
+        if data.empty:
+            return data
+        entry = _store_full_download(ticker, data, entry, session, start)
+    return entry["data"]
+
+
+def prefetch_prices(tickers, period="1y", chunk_size=None):
+    """
+    Loads many tickers into the price cache using multi-ticker yf.download calls.
+
+    Tickers already fresh in the cache are skipped; the rest are downloaded chunk_size symbols
+    per request. Afterwards get_price_history() answers each of them without a download, from
+    memory for the last PRICE_CACHE_SIZE tickers and from disk for the rest.
+
+    Returns:
+    - The number of tickers that had to be downloaded.
+    """
+    return fresh_price_entries(tickers, period, chunk_size)[1]
+
+
+def fresh_price_entries(tickers, period="1y", chunk_size=None):
+    """
+    Brings many tickers up to date in the price cache, reading each stored file once, and
+    returns their entries so a caller can use the bars without loading them again.
+
+    Returns:
+    - (entries, downloaded): a dict mapping each ticker that has data, upper-cased and in the
+      order given, to its cache entry, and the number of tickers that had to be downloaded.
+    """
+    if chunk_size is None:
+        chunk_size = WATCHLIST_CHUNK_SIZE
+    tickers = list(dict.fromkeys(ticker.strip().upper() for ticker in tickers))
+    start = _period_start(period)
+    session = last_completed_session()
+
+    # Parquet reads release the GIL, so a few threads overlap the file I/O
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        looked_up = dict(zip(tickers, executor.map(_lookup_price_entry, tickers)))
+
+    entries, stale = {}, {}
+    for ticker, (entry, source) in looked_up.items():
+        if _covers(entry, start) and entry["checked_through"] >= session:
+            _count_price_cache(source)
+            entries[ticker] = entry
+        else:
+            stale[ticker] = entry
+
+    names = list(stale)
+    for offset in range(0, len(names), chunk_size):
+        chunk = names[offset:offset + chunk_size]
+        with span("yfinance download", tickers=len(chunk), period=period):
+            data = yf.download(chunk, period=period, group_by="ticker", threads=True, progress=False)
+        for ticker in chunk:
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                bars = data[ticker]
+            else:
+                bars = data
+            bars = _completed_bars(bars.dropna(how="all"), session)
+            if bars.empty:
+                continue
+            _count_price_cache("misses")
+            entries[ticker] = _store_full_download(ticker, bars, stale[ticker], session, start)
+    return {ticker: entries[ticker] for ticker in tickers if ticker in entries}, len(names)
+
+
+def price_cache_info():
+    with _price_lock:
+        cached_tickers = len(_price_memory)
+    return dict(price_cache_stats, cached_tickers=cached_tickers)
+
+
+# Calendar days shown for each timeframe option in the sidebar
+TIMEFRAME_DAYS = {"1 Month": 31, "3 Months": 92, "6 Months": 183, "1 Year": 366}
+
+INDICATOR_COLUMNS = [
+    'SMA_20', 'SMA_50', 'SMA_200', 'RSI', 'MACD', 'MACD_signal', 'MACD_hist',
+    'OBV', 'ADX', 'upper_band', 'middle_band', 'lower_band',
+]
+
+_indicator_memory = OrderedDict()
+
+
+def _padded_cumsum(values):
+    # Cumulative sum along the time axis with a leading row of zeros
+    csum = np.zeros((len(values) + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=csum[1:])
+    return csum
+
+
+def _rolling_sum(csum, window):
+    # Trailing-window sums from a padded cumulative sum; the first window - 1 rows are NaN
+    out = np.full((len(csum) - 1,) + csum.shape[1:], np.nan)
+    if len(csum) > window:
+        out[window - 1:] = csum[window:] - csum[:-window]
+    return out
+
+
+def _rolling_moments(values, windows, variance_window=None):
+    """
+    Trailing means for several windows from one shared pair of cumulative sums, plus the
+    population variance for variance_window measured around those same means.
+    """
+    valid = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        center = np.nan_to_num(np.nanmean(values, axis=0))
+    centred = np.where(valid, values - center, 0.0)
+    sums = _padded_cumsum(centred)
+    counts = _padded_cumsum(valid.astype(float))
+
+    means = {}
+    for window in windows:
+        full = _rolling_sum(counts, window) == window
+        means[window] = np.where(full, _rolling_sum(sums, window) / window + center, np.nan)
+
+    variance = None
+    if variance_window is not None:
+        window = variance_window
+        mean = means[window]
+        variance = np.full(values.shape, np.nan)
+        # Deviations are taken inside each window, a few million elements at a time, because
+        # differencing cumulative sums of squares loses precision on long, trending series
+        chunk = max(1, 4_000_000 // (window * max(1, values[0].size)))
+        for start in range(window - 1, len(values), chunk):
+            stop = min(start + chunk, len(values))
+            windows = sliding_window_view(values[start - window + 1:stop], window, axis=0)
+            variance[start:stop] = np.mean((windows - mean[start:stop, ..., None]) ** 2, axis=-1)
+    return means, variance
+
+
+def _decay_cumsum(values, decay):
+    """
+    out[t] = sum over j <= t of decay ** (t - j) * values[j], along the time axis.
+
+    Evaluated as closed-form cumulative sums over blocks short enough that decay ** -block
+    stays within float range, carrying the running total between blocks.
+    """
+    out = np.empty(values.shape)
+    block = max(1, int(500 / -np.log(decay)))
+    carry = np.zeros(values.shape[1:])
+    shape = (-1,) + (1,) * (values.ndim - 1)
+    exponents = np.arange(min(block, len(values))) * np.log(decay)
+    powers = np.exp(exponents).reshape(shape)
+    inverse_powers = np.exp(-exponents).reshape(shape)
+    for start in range(0, len(values), block):
+        segment = values[start:start + block]
+        size = len(segment)
+        running = np.cumsum(segment * inverse_powers[:size], axis=0)
+        running += carry * decay
+        running *= powers[:size]
+        out[start:start + size] = running
+        carry = running[-1]
+    return out
+
+
+def _ewm_mean(values, alpha, min_periods):
+    # pandas' ewm(alpha=alpha, min_periods=min_periods).mean(): NaNs are skipped but still age the weights
+    valid = ~np.isnan(values)
+    observed = np.cumsum(valid, axis=0)
+    weighted = _decay_cumsum(np.where(valid, values, 0.0), 1.0 - alpha)
+    if np.array_equal(valid, observed > 0):
+        # No gaps after the first value, so the weights are a plain geometric series
+        weights = -np.expm1(observed * np.log1p(-alpha)) / alpha
+    else:
+        weights = _decay_cumsum(valid.astype(float), 1.0 - alpha)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = weighted / weights
+    out[observed < min_periods] = np.nan
+    return out
+
+
+def _ewm_unadjusted(values, alpha):
+    """
+    pandas' ewm(alpha=alpha, adjust=False).mean() for a 1-D series whose first value is present.
+
+    A missing value repeats the previous mean, and the next value present is blended in as if
+    the old mean had decayed once per missing row. Each run of values between gaps is one
+    closed-form _decay_cumsum.
+    """
+    out = np.full(values.shape, np.nan)
+    present = np.flatnonzero(~np.isnan(values))
+    breaks = np.flatnonzero(np.diff(present) > 1) + 1
+    mean = last = None
+    for run in np.split(present, breaks):
+        first, stop = run[0], run[-1] + 1
+        segment = values[first:stop].copy()
+        if mean is not None:
+            decay = (1.0 - alpha) ** (first - last)
+            segment[0] = (decay * mean + alpha * segment[0]) / (decay + alpha)
+        segment[0] /= alpha
+        out[first:stop] = alpha * _decay_cumsum(segment, 1.0 - alpha)
+        out[stop:] = out[stop - 1]
+        mean, last = out[stop - 1], stop - 1
+    return out
+
+
+def _ema(values, length):
+    # pandas_ta's ema: seeded with the SMA of the first `length` values, then ewm(adjust=False)
+    out = np.full(values.shape, np.nan)
+    complete_rows = ~np.isnan(values).reshape(len(values), -1).any(axis=1)
+    if not complete_rows.any():
+        return out
+    start = int(np.argmax(complete_rows))
+    seed = start + length - 1
+    if seed >= len(values):
+        return out
+    alpha = 2.0 / (length + 1)
+    series = values[seed:].copy()
+    series[0] = values[start:seed + 1].mean(axis=0)
+    gaps = np.isnan(series).reshape(len(series), -1).any(axis=0)
+    if gaps.any():
+        # Series with missing bars after the seed go one at a time; the rest stay vectorized
+        flat = series.reshape(len(series), -1)
+        smoothed = np.empty(flat.shape)
+        for column in np.flatnonzero(gaps):
+            smoothed[:, column] = _ewm_unadjusted(flat[:, column], alpha)
+        complete = ~gaps
+        flat[0, complete] /= alpha
+        smoothed[:, complete] = alpha * _decay_cumsum(flat[:, complete], 1.0 - alpha)
+        out[seed:] = smoothed.reshape(series.shape)
+        return out
+    series[0] /= alpha
+    out[seed:] = alpha * _decay_cumsum(series, 1.0 - alpha)
+    return out
+
+
+def _lagged(values):
+    out = np.full(values.shape, np.nan)
+    out[1:] = values[:-1]
+    return out
+
+
+def _true_range(high, low, close):
+    prev_close = _lagged(close)
+    true_range = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(prev_close - low)))
+    true_range[0] = np.nan
+    return true_range
+
+
+def _rsi(close, length=14):
+    change = close - _lagged(close)
+    with np.errstate(invalid="ignore"):
+        gains = np.where(change > 0, change, 0.0)
+        losses = np.where(change < 0, -change, 0.0)
+    gains[np.isnan(change)] = np.nan
+    losses[np.isnan(change)] = np.nan
+    average_gain = _ewm_mean(gains, 1.0 / length, length)
+    average_loss = _ewm_mean(losses, 1.0 / length, length)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 100.0 * average_gain / (average_gain + average_loss)
+
+
+def _macd(close, fast=12, slow=26, signal=9):
+    macd = _ema(close, fast) - _ema(close, slow)
+    signal_line = _ema(macd, signal)
+    return macd, signal_line, macd - signal_line
+
+
+def _obv(close, volume):
+    direction = np.ones(close.shape)
+    direction[1:] = np.sign(np.diff(close, axis=0))
+    signed_volume = direction * volume
+    # A missing close or volume leaves OBV undefined on that bar, and a missing close also on
+    # the bar after it, without resetting the running total
+    obv = np.nancumsum(signed_volume, axis=0)
+    obv[np.isnan(signed_volume)] = np.nan
+    return obv
+
+
+def _adx(high, low, close, length=14, true_range=None):
+    if true_range is None:
+        true_range = _true_range(high, low, close)
+    alpha = 1.0 / length
+    atr = _ewm_mean(true_range, alpha, length)
+
+    up = high - _lagged(high)
+    down = _lagged(low) - low
+    with np.errstate(invalid="ignore"):
+        plus_move = np.where((up > down) & (up > 0), up, 0.0)
+        minus_move = np.where((down > up) & (down > 0), down, 0.0)
+    plus_move[np.isnan(up)] = np.nan
+    minus_move[np.isnan(down)] = np.nan
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        plus_di = 100.0 * _ewm_mean(plus_move, alpha, length) / atr
+        minus_di = 100.0 * _ewm_mean(minus_move, alpha, length) / atr
+        dx = 100.0 * np.abs(plus_di - minus_di) / (plus_di + minus_di)
+    return _ewm_mean(dx, alpha, length)
+
+
+def compute_indicator_block(high, low, close, volume):
+    """
+    Computes every INDICATOR_COLUMNS series in one pass over contiguous float arrays.
+
+    The 20/50/200 rolling means share one cumulative sum, SMA_20 doubles as the Bollinger
+    middle band, and the true range feeds ADX. Results follow pandas_ta's definitions.
+
+    Returns:
+    - A (len(close), len(INDICATOR_COLUMNS)) float64 array in INDICATOR_COLUMNS order.
+    """
+    block = np.full((len(close), len(INDICATOR_COLUMNS)), np.nan)
+    column = {name: i for i, name in enumerate(INDICATOR_COLUMNS)}
+
+    with span("indicator SMA"):
+        means, variance = _rolling_moments(close, (20, 50, 200), variance_window=20)
+        block[:, column['SMA_20']] = means[20]
+        block[:, column['SMA_50']] = means[50]
+        block[:, column['SMA_200']] = means[200]
+
+    with span("indicator RSI"):
+        block[:, column['RSI']] = _rsi(close, 14)
+
+    with span("indicator MACD"):
+        macd, signal_line, histogram = _macd(close)
+        block[:, column['MACD']] = macd
+        block[:, column['MACD_signal']] = signal_line
+        block[:, column['MACD_hist']] = histogram
+
+    with span("indicator OBV"):
+        block[:, column['OBV']] = _obv(close, volume)
+    with span("indicator ADX"):
+        block[:, column['ADX']] = _adx(high, low, close, 14)
+
+    with span("indicator Bollinger Bands"):
+        deviation = 2.0 * np.sqrt(variance)
+        block[:, column['upper_band']] = means[20] + deviation
+        block[:, column['middle_band']] = means[20]
+        block[:, column['lower_band']] = means[20] - deviation
+    return block
+
+
+def add_indicators(data):
+    # Returns a copy of the OHLCV frame with every INDICATOR_COLUMNS column attached
+    arrays = [
+        data[field].to_numpy(dtype=float) if field in data.columns else np.full(len(data), np.nan)
+        for field in ('High', 'Low', 'Close', 'Volume')
+    ]
+    block = compute_indicator_block(*arrays)
+    indicators = pd.DataFrame(block, index=data.index, columns=INDICATOR_COLUMNS)
+    return pd.concat([data.drop(columns=INDICATOR_COLUMNS, errors='ignore'), indicators], axis=1)
+
+
+def pandas_ta_indicators(data):
+    # Reference implementation with pandas_ta, used to check compute_indicator_block
+    data = data.copy()
+    for column in INDICATOR_COLUMNS:
+        data[column] = float("nan")
+
+    data['SMA_20'] = ta.sma(data['Close'], length=20)
+    data['SMA_50'] = ta.sma(data['Close'], length=50)
+    data['SMA_200'] = ta.sma(data['Close'], length=200)
+    data['RSI'] = ta.rsi(data['Close'], length=14)
+
+    macd = ta.macd(data['Close'])
+    if macd is not None and 'MACD_12_26_9' in macd.columns and 'MACDs_12_26_9' in macd.columns and 'MACDh_12_26_9' in macd.columns:
+        data['MACD'] = macd['MACD_12_26_9']
+        data['MACD_signal'] = macd['MACDs_12_26_9']
+        data['MACD_hist'] = macd['MACDh_12_26_9']
+
+    if 'Volume' in data.columns:
+        data['OBV'] = ta.obv(data['Close'], data['Volume'])
+
+    adx = ta.adx(data['High'], data['Low'], data['Close'])
+    if adx is not None and 'ADX_14' in adx.columns:
+        data['ADX'] = adx['ADX_14']
+
+    bbands = ta.bbands(data['Close'], length=20, std=2)
+    if bbands is not None and 'BBU_20_2.0' in bbands.columns and 'BBM_20_2.0' in bbands.columns and 'BBL_20_2.0' in bbands.columns:
+        data['upper_band'] = bbands['BBU_20_2.0']
+        data['middle_band'] = bbands['BBM_20_2.0']
+        data['lower_band'] = bbands['BBL_20_2.0']
+
+    return data
+
+
+def synthetic_ohlcv(length, freq="B", seed=0):
+    # Random-walk OHLCV bars for benchmarks
+    rng = np.random.default_rng(seed)
+    close = 100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.01, length)))
+    spread = np.abs(rng.normal(0.0, 0.005, length)) * close
+    index = pd.date_range("2000-01-03", periods=length, freq=freq)
+    return pd.DataFrame({
+        'Open': close * (1 + rng.normal(0.0, 0.002, length)),
+        'High': close + spread,
+        'Low': close - spread,
+        'Close': close,
+        'Volume': rng.integers(100_000, 5_000_000, length).astype(float),
+    }, index=index)
+
+
+def indicator_parity(data):
+    # Largest absolute difference per column between the NumPy engine and pandas_ta
+    engine = add_indicators(data)
+    reference = pandas_ta_indicators(data)
+    return {column: float(np.nanmax(np.abs(engine[column] - reference[column]).to_numpy(), initial=0.0)) for column in INDICATOR_COLUMNS}
+
+
+def benchmark_indicator_engine(lengths=None, repeats=5):
+    """
+    Times add_indicators against the pandas_ta implementation on synthetic series.
+
+    Returns:
+    - A DataFrame with one row per series length: best-of-`repeats` timings in milliseconds,
+      the speedup, and the largest parity difference across all indicator columns.
+    """
+    if lengths is None:
+        lengths = {"1y daily": (252, "B"), "10y daily": (2520, "B"), "intraday 1m": (100_000, "min")}
+    rows = []
+    for label, (length, freq) in lengths.items():
+        data = synthetic_ohlcv(length, freq)
+        timings = {}
+        for name, compute in (("engine", add_indicators), ("pandas_ta", pandas_ta_indicators)):
+            best = float("inf")
+            for _ in range(repeats):
+                started = time.perf_counter()
+                compute(data)
+                best = min(best, time.perf_counter() - started)
+            timings[name] = best * 1000
+        rows.append({
+            "series": label,
+            "bars": length,
+            "engine_ms": round(timings["engine"], 2),
+            "pandas_ta_ms": round(timings["pandas_ta"], 2),
+            "speedup": round(timings["pandas_ta"] / timings["engine"], 1),
+            "max_abs_diff": max(indicator_parity(data).values()),
+        })
+    return pd.DataFrame(rows)
+
+
+# Rule-based versions of the setups the indicator prompts describe, with their default parameters.
+# Every strategy is long-only and can be limited to trending markets with adx_min.
+BACKTEST_STRATEGIES = {
+    "SMA Crossover": {"fast": 50, "slow": 200, "adx_min": 0},
+    "RSI Reversion": {"length": 14, "lower": 30, "upper": 70, "adx_min": 0},
+    "MACD Cross": {"fast": 12, "slow": 26, "signal": 9, "adx_min": 0},
+    "Bollinger Breakout": {"length": 20, "std": 2.0, "adx_min": 0},
+}
+
+# Parameter grids swept by default for each strategy
+BACKTEST_SWEEPS = {
+    "SMA Crossover": {"fast": [10, 20, 50], "slow": [100, 150, 200], "adx_min": [0, 20]},
+    "RSI Reversion": {"lower": [20, 25, 30, 35], "upper": [60, 70, 80], "adx_min": [0]},
+    "MACD Cross": {"fast": [8, 12], "slow": [21, 26], "signal": [9], "adx_min": [0, 20, 25]},
+    "Bollinger Breakout": {"length": [20], "std": [1.5, 2.0, 2.5], "adx_min": [0, 20, 25]},
+}
+
+TRADING_DAYS = 252
+
+
+def _hold_between(entries, exits):
+    # 1 from each entry until the next exit, per column, without a loop over bars
+    events = np.where(entries, 1.0, np.where(exits, 0.0, np.nan))
+    rows = np.arange(len(events)).reshape((-1,) + (1,) * (events.ndim - 1))
+    last_event = np.maximum.accumulate(np.where(np.isnan(events), 0, rows), axis=0)
+    held = np.take_along_axis(events, last_event, axis=0)
+    return np.nan_to_num(held)
+
+
+class Backtester:
+    """
+    Vectorized long-only backtests of the app's indicator rules over a dates x tickers panel.
+
+    Positions are decided on each close and earn the next bar's return, less cost_bps per
+    unit of turnover. Indicator arrays are memoized per parameter set, so a parameter sweep
+    only redoes the position and return arithmetic.
+    """
+
+    def __init__(self, panel, cost_bps=5.0):
+        self.tickers = list(panel["Close"].columns)
+        self.index = panel["Close"].index
+        self.close = panel["Close"].ffill().to_numpy(dtype=float)
+        self.high = panel["High"].to_numpy(dtype=float)
+        self.low = panel["Low"].to_numpy(dtype=float)
+        self.cost = cost_bps / 10_000
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = self.close / _lagged(self.close) - 1
+        self.valid = ~np.isnan(returns)
+        self.returns = np.where(self.valid, returns, 0.0)
+        self._indicators = {}
+
+    def indicator(self, name, *params):
+        key = (name,) + params
+        if key not in self._indicators:
+            if name == "sma":
+                self._indicators[key] = _rolling_moments(self.close, params)[0][params[0]]
+            elif name == "rsi":
+                self._indicators[key] = _rsi(self.close, *params)
+            elif name == "macd":
+                self._indicators[key] = _macd(self.close, *params)
+            elif name == "bbands":
+                length, std = params
+                means, variance = _rolling_moments(self.close, (length,), variance_window=length)
+                deviation = std * np.sqrt(variance)
+                self._indicators[key] = (means[length] + deviation, means[length], means[length] - deviation)
+            elif name == "adx":
+                self._indicators[key] = _adx(self.high, self.low, self.close, *params)
+            else:
+                raise ValueError(f"Unknown indicator {name!r}")
+        return self._indicators[key]
+
+    def positions(self, strategy, **params):
+        """
+        Returns the (dates x tickers) array of positions, 1 long and 0 flat, decided on each close.
+        """
+        params = dict(BACKTEST_STRATEGIES[strategy], **params)
+        close = self.close
+        with np.errstate(invalid="ignore"):
+            if strategy == "SMA Crossover":
+                held = self.indicator("sma", params["fast"]) > self.indicator("sma", params["slow"])
+            elif strategy == "RSI Reversion":
+                rsi = self.indicator("rsi", params["length"])
+                held = _hold_between(rsi < params["lower"], rsi > params["upper"])
+            elif strategy == "MACD Cross":
+                macd, signal_line, _ = self.indicator("macd", params["fast"], params["slow"], params["signal"])
+                held = macd > signal_line
+            elif strategy == "Bollinger Breakout":
+                upper, middle, _ = self.indicator("bbands", params["length"], params["std"])
+                held = _hold_between(close > upper, close < middle)
+            else:
+                raise ValueError(f"Unknown strategy {strategy!r}")
+            held = held.astype(float)
+            if params["adx_min"]:
+                held *= self.indicator("adx", 14) > params["adx_min"]
+        return held
+
+    def run(self, strategy, **params):
+        """
+        Backtests one strategy on every ticker.
+
+        Returns:
+        - A DataFrame with one row per ticker: CAGR, maximum drawdown, hit rate (share of closed
+          and open trades that made money), trade count, time in market, and buy-and-hold CAGR.
+        """
+        held = _lagged(self.positions(strategy, **params))
+        held[0] = 0.0
+        turnover = np.abs(np.diff(held, axis=0, prepend=0.0))
+        strategy_returns = held * self.returns - turnover * self.cost
+        log_returns = np.log1p(strategy_returns)
+
+        years = self.valid.sum(axis=0) / TRADING_DAYS
+        equity = np.cumsum(log_returns, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cagr = np.expm1(equity[-1] / years)
+            buy_and_hold = np.expm1(np.log1p(self.returns).sum(axis=0) / years)
+        drawdown = np.expm1(equity - np.maximum.accumulate(np.maximum(equity, 0.0), axis=0)).min(axis=0)
+
+        # Trades are numbered per column; summing log returns by (column, trade) gives each trade's return
+        in_market = held > 0
+        entries = in_market & ~np.vstack([np.zeros((1, in_market.shape[1]), bool), in_market[:-1]])
+        trade_ids = np.cumsum(entries, axis=0) * in_market
+        slots = int(trade_ids.max()) + 1
+        flat_ids = (trade_ids + np.arange(in_market.shape[1]) * slots).ravel()
+        trade_returns = np.bincount(flat_ids, weights=log_returns.ravel(), minlength=slots * in_market.shape[1])
+        trade_returns = trade_returns.reshape(in_market.shape[1], slots)[:, 1:]
+        trades = entries.sum(axis=0)
+        wins = (trade_returns > 0).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hit_rate = np.where(trades > 0, wins / trades, np.nan)
+
+        return pd.DataFrame({
+            "Ticker": self.tickers,
+            "CAGR %": np.round(cagr * 100, 2),
+            "Max Drawdown %": np.round(drawdown * 100, 2),
+            "Hit Rate %": np.round(hit_rate * 100, 1),
+            "Trades": trades,
+            "Time in Market %": np.round(in_market.mean(axis=0) * 100, 1),
+            "Buy & Hold CAGR %": np.round(buy_and_hold * 100, 2),
+        })
+
+    def summary(self, results):
+        # Cross-ticker medians of a run() table, one value per metric
+        return results.drop(columns="Ticker").median(numeric_only=True).round(2).to_dict()
+
+    def sweep(self, strategy, grid=None):
+        """
+        Runs every combination of the parameter grid (defaults to BACKTEST_SWEEPS[strategy]).
+
+        Returns:
+        - A DataFrame with one row per parameter set and the cross-ticker medians of its run,
+          best median CAGR first.
+        """
+        grid = grid or BACKTEST_SWEEPS[strategy]
+        rows = []
+        for values in product(*grid.values()):
+            params = dict(zip(grid, values))
+            if strategy in ("SMA Crossover", "MACD Cross") and params.get("fast", 0) >= params.get("slow", 1):
+                continue
+            rows.append(dict(params, **self.summary(self.run(strategy, **params))))
+        return pd.DataFrame(rows).sort_values("CAGR %", ascending=False, ignore_index=True)
+
+
+def load_backtester(tickers, years=10, cost_bps=5.0):
+    # Backtester over the cached daily bars of the tickers for the last `years` years
+    period = "10y" if years > 5 else "5y" if years > 2 else "2y"
+    panel = load_price_panel(tickers, period)
+    if not panel:
+        return None
+    start = pd.Timestamp(datetime.now(MARKET_TZ).date() - timedelta(days=int(365.25 * years)))
+    return Backtester({field: frame.loc[start:] for field, frame in panel.items()}, cost_bps)
+
+
+def render_backtest(backtester, strategy, params, sweep=False):
+    results = backtester.run(strategy, **params)
+    summary = backtester.summary(results)
+    st.subheader(f"{strategy} Backtest")
+    columns = st.columns(4)
+    for column, metric in zip(columns, ("CAGR %", "Max Drawdown %", "Hit Rate %", "Buy & Hold CAGR %")):
+        column.metric(f"Median {metric}", f"{summary[metric]:.2f}")
+    st.dataframe(results, use_container_width=True, hide_index=True)
+    if sweep:
+        st.subheader("Parameter Sweep")
+        started = time.perf_counter()
+        table = backtester.sweep(strategy)
+        st.caption(f"{len(table)} parameter sets in {time.perf_counter() - started:.2f} s")
+        st.dataframe(table, use_container_width=True, hide_index=True)
+
+
+def synthetic_panel(symbols, bars, seed=0):
+    # Random-walk OHLCV panels of dates x symbols for the screener benchmark
+    rng = np.random.default_rng(seed)
+    close = 100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.01, (bars, symbols)), axis=0))
+    spread = np.abs(rng.normal(0.0, 0.005, (bars, symbols))) * close
+    index = pd.date_range("2000-01-03", periods=bars, freq="B")
+    columns = [f"SYM{i:04d}" for i in range(symbols)]
+    return {
+        field: pd.DataFrame(values, index=index, columns=columns)
+        for field, values in (("High", close + spread), ("Low", close - spread), ("Close", close),
+                              ("Volume", rng.integers(100_000, 5_000_000, (bars, symbols)).astype(float)))
+    }
+
+
+def benchmark_screener(symbols=1000, bars=504, repeats=3, period=INDICATOR_HISTORY_PERIOD):
+    """
+    Times loading a synthetic universe from a warm on-disk price cache with load_price_panel,
+    and screen_panel on it against computing the same factors one ticker at a time with
+    add_indicators, the single-ticker path.
+
+    Returns:
+    - A one-row DataFrame with the timings in milliseconds, the speedup of the screening step,
+      and the largest difference in RSI and ADX between the two.
+    """
+    global PRICE_CACHE_DIR
+    panel = synthetic_panel(symbols, bars)
+    tickers = list(panel["Close"].columns)
+
+    # The cache is written to a scratch directory, dated to end at the latest session so it is fresh
+    cache_dir, PRICE_CACHE_DIR = PRICE_CACHE_DIR, tempfile.mkdtemp(prefix="screener_benchmark_")
+    try:
+        session = last_completed_session()
+        index = pd.bdate_range(end=pd.Timestamp(session), periods=bars)
+        for ticker in tickers:
+            frame = pd.DataFrame({field: panel[field][ticker].to_numpy() for field in panel}, index=index)
+            _save_price_entry(ticker, {"data": frame, "checked_through": session, "covered_from": _period_start(period)})
+        started = time.perf_counter()
+        loaded = load_price_panel(tickers, period)
+        load_seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(PRICE_CACHE_DIR, ignore_errors=True)
+        PRICE_CACHE_DIR = cache_dir
+    if len(loaded["Close"].columns) != symbols:
+        raise RuntimeError(f"Loaded {len(loaded['Close'].columns)} of {symbols} tickers from the cache")
+
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        table = screen_panel(panel)
+        best = min(best, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    per_ticker = {}
+    for ticker in panel["Close"].columns:
+        data = add_indicators(pd.DataFrame({field: panel[field][ticker] for field in panel}))
+        per_ticker[ticker] = data[["RSI", "ADX"]].iloc[-1]
+    looped = time.perf_counter() - started
+
+    reference = pd.DataFrame(per_ticker).T.loc[table["Ticker"]]
+    difference = max(np.nanmax(np.abs(table[column].to_numpy() - reference[column].round(1).to_numpy())) for column in ("RSI", "ADX"))
+    return pd.DataFrame([{
+        "symbols": symbols,
+        "bars": bars,
+        "cache_load_ms": round(load_seconds * 1000, 2),
+        "panel_ms": round(best * 1000, 2),
+        "per_ticker_ms": round(looped * 1000, 2),
+        "speedup": round(looped / best, 1),
+        "max_abs_diff": float(difference),
+    }])
+
+
+def benchmark_backtester(symbols=500, years=10, repeats=3):
+    """
+    Times the backtester on a synthetic universe of years x TRADING_DAYS bars per symbol.
+
+    Returns:
+    - A DataFrame with one row per strategy: the first run including its indicator pass, a
+      repeat run with the indicators memoized, and a full BACKTEST_SWEEPS sweep, in milliseconds.
+    """
+    backtester = Backtester(synthetic_panel(symbols, years * TRADING_DAYS))
+    rows = []
+    for strategy in BACKTEST_STRATEGIES:
+        started = time.perf_counter()
+        backtester.run(strategy)
+        first = time.perf_counter() - started
+        repeat = float("inf")
+        for _ in range(repeats):
+            started = time.perf_counter()
+            backtester.run(strategy)
+            repeat = min(repeat, time.perf_counter() - started)
+        started = time.perf_counter()
+        sweep = backtester.sweep(strategy)
+        rows.append({
+            "strategy": strategy,
+            "symbols": symbols,
+            "bars": years * TRADING_DAYS,
+            "first_run_ms": round(first * 1000, 1),
+            "repeat_run_ms": round(repeat * 1000, 1),
+            "sweep_sets": len(sweep),
+            "sweep_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+    return pd.DataFrame(rows)
+
+
+def get_indicator_history(ticker):
+    """
+    Returns the full INDICATOR_HISTORY_PERIOD of bars for the ticker with indicators attached.
+
+    The result is memoized per ticker and only recomputed when the underlying bars change,
+    so switching timeframes costs neither a download nor an indicator pass.
+    """
+    ticker = ticker.strip().upper()
+    prices = get_price_history(ticker, period=INDICATOR_HISTORY_PERIOD)
+    if prices.empty:
+        return prices
+    version = (len(prices), prices.index[-1], float(prices['Close'].iloc[-1]))
+
+    with _price_lock:
+        cached = _indicator_memory.get(ticker)
+        if cached is not None and cached[0] == version:
+            _indicator_memory.move_to_end(ticker)
+            return cached[1]
+
+    with span("indicators", ticker=ticker, bars=len(prices)):
+        data = add_indicators(prices)
+    with _price_lock:
+        _indicator_memory[ticker] = (version, data)
+        _indicator_memory.move_to_end(ticker)
+        while len(_indicator_memory) > PRICE_CACHE_SIZE:
+            _indicator_memory.popitem(last=False)
+    return data
+
+
+def load_timeframe(ticker, timeframe):
+    # Slicing a sorted DatetimeIndex by label returns views, not copies, of the shared frame
+    data = get_indicator_history(ticker)
+    if data.empty:
+        return data
+    start = pd.Timestamp(datetime.now(MARKET_TZ).date() - timedelta(days=TIMEFRAME_DAYS[timeframe]))
+    return data.loc[start:]
+
+
+def resample_weekly(data):
+    return data.resample('W').agg({
+        'Open': 'first',
+        'High': 'max',
+        'Low': 'min',
+        'Close': 'last',
+        'Volume': 'sum',
+        'SMA_20': 'last',
+        'SMA_50': 'last',
+        'SMA_200': 'last',
+        'RSI': 'last',
+        'MACD': 'last',
+        'MACD_signal': 'last',
+        'MACD_hist': 'last',
+        'OBV': 'last',
+        'ADX': 'last',
+        'upper_band': 'last',
+        'middle_band': 'last',
+        'lower_band': 'last'
+    })
+
+
+# Columns each indicator prompt needs; the full OHLC block is only sent where the indicator uses it
+PROMPT_COLUMNS = {
+    "Bollinger Bands": ["High", "Low", "Close", "upper_band", "middle_band", "lower_band"],
+    "SMA": ["Close", "SMA_20", "SMA_50", "SMA_200"],
+    "RSI": ["Close", "RSI"],
+    "OBV": ["Close", "Volume", "OBV"],
+    "ADX": ["High", "Low", "Close", "ADX"],
+    "MACD": ["Close", "MACD", "MACD_signal", "MACD_hist"],
+}
+
+# The markdown tables the prompts were built from before, kept for the token comparison
+MARKDOWN_PROMPT_COLUMNS = {
+    "Bollinger Bands": ["Open", "High", "Low", "Close", "Volume", "upper_band", "middle_band", "lower_band"],
+    "SMA": ["Open", "High", "Low", "Close", "SMA_20", "SMA_50", "SMA_200"],
+    "RSI": ["Open", "High", "Low", "Close", "RSI"],
+    "OBV": ["Open", "High", "Low", "Close", "Volume", "OBV"],
+    "ADX": ["Open", "High", "Low", "Close", "ADX"],
+    "MACD": ["Open", "High", "Low", "Close", "MACD", "MACD_signal", "MACD_hist"],
+}
+
+PRICE_COLUMNS = {"Open", "High", "Low", "Close", "SMA_20", "SMA_50", "SMA_200",
+                 "upper_band", "middle_band", "lower_band", "MACD", "MACD_signal", "MACD_hist"}
+VOLUME_COLUMNS = {"Volume", "OBV"}
+
+_token_encoding = None
+
+
+def count_tokens(text):
+    # gpt-4o tokenizer; the encoding is loaded once on first use
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = tiktoken.encoding_for_model("gpt-4o")
+    return len(_token_encoding.encode(text))
+
+
+def _price_decimals(close):
+    # Two decimals for ordinary prices, more for sub-dollar stocks so small moves stay visible
+    level = close.abs().median()
+    if not np.isfinite(level) or level <= 0:
+        return 2
+    return int(max(2, 3 - np.floor(np.log10(level))))
+
+
+def _compact_number(value):
+    if not np.isfinite(value):
+        return ""
+    for divisor, suffix in ((1e9, "B"), (1e6, "M"), (1e3, "K")):
+        if abs(value) >= divisor:
+            return f"{value / divisor:.2f}{suffix}"
+    return f"{value:.0f}"
+
+
+def _format_column(series, price_decimals):
+    if series.name in VOLUME_COLUMNS:
+        return series.map(_compact_number)
+    decimals = price_decimals if series.name in PRICE_COLUMNS else 1
+    return series.map(lambda value: f"{value:.{decimals}f}" if np.isfinite(value) else "")
+
+
+def serialize_for_prompt(data, columns):
+    """
+    Encodes indicator data as compact CSV for a prompt.
+
+    Dates are written without times, prices are rounded to the precision the price level
+    needs, oscillators to one decimal and volumes with K/M/B suffixes. Rows where every
+    requested column is still empty (indicator warm-up) are dropped.
+    """
+    frame = data[columns].dropna(how="all")
+    price_decimals = _price_decimals(data["Close"])
+    formatted = pd.DataFrame({column: _format_column(frame[column].astype(float), price_decimals) for column in columns})
+    formatted.insert(0, "date", frame.index.strftime("%Y-%m-%d"))
+    return formatted.to_csv(index=False, lineterminator="\n").strip()
+
+
+def _last_cross(fast, slow):
+    # Date and direction of the most recent time fast crossed slow, or None
+    above = (fast - slow).dropna() > 0
+    flips = above.ne(above.shift()) & above.shift().notna()
+    if not flips.any():
+        return None
+    when = flips[flips].index[-1]
+    return f"{'above' if above[when] else 'below'} on {when:%Y-%m-%d}"
+
+
+def _trend(series, periods=4):
+    # Change over the last few rows, the "slope" the prompts ask the model to judge
+    values = series.dropna()
+    if len(values) <= periods:
+        return float("nan")
+    return values.iloc[-1] - values.iloc[-1 - periods]
+
+
+def indicator_digest(data, label):
+    """
+    Precomputed features for one indicator: latest values, recent slope, crossovers and band
+    position. Sent ahead of the table so the model does not have to derive them itself.
+    """
+    latest = data.ffill().iloc[-1]
+    decimals = _price_decimals(data["Close"])
+    close = data["Close"]
+    lines = [f"Latest close {latest['Close']:.{decimals}f} on {data.index[-1]:%Y-%m-%d}; "
+             f"{(latest['Close'] / close.dropna().iloc[0] - 1) * 100:+.1f}% over the period"]
+
+    if label == "Bollinger Bands":
+        width = latest["upper_band"] - latest["lower_band"]
+        percent_b = (latest["Close"] - latest["lower_band"]) / width if width else float("nan")
+        bandwidth = (data["upper_band"] - data["lower_band"]) / data["middle_band"]
+        lines.append(f"%B {percent_b:.2f} (0 = lower band, 1 = upper band); band width {bandwidth.iloc[-1]:.3f} "
+                     f"vs {bandwidth.mean():.3f} average")
+        lines.append(f"Weeks closing above upper band: {int((close > data['upper_band']).sum())}, "
+                     f"below lower band: {int((close < data['lower_band']).sum())}")
+    elif label == "SMA":
+        for column in ("SMA_20", "SMA_50", "SMA_200"):
+            if np.isfinite(latest[column]):
+                lines.append(f"{column} {latest[column]:.{decimals}f}, close {(latest['Close'] / latest[column] - 1) * 100:+.1f}% "
+                             f"from it, 4-week change {_trend(data[column]):+.{decimals}f}")
+        for fast, slow in (("Close", "SMA_50"), ("SMA_20", "SMA_50"), ("SMA_50", "SMA_200")):
+            cross = _last_cross(data[fast], data[slow])
+            if cross:
+                lines.append(f"{fast} last crossed {cross.replace(' on', f' {slow} on')}")
+    elif label == "RSI":
+        rsi = data["RSI"].dropna()
+        zone = "overbought" if latest["RSI"] > 70 else "oversold" if latest["RSI"] < 30 else "neutral"
+        lines.append(f"RSI {latest['RSI']:.1f} ({zone}), 4-week change {_trend(rsi):+.1f}, "
+                     f"range {rsi.min():.1f}-{rsi.max():.1f}, weeks above 70: {int((rsi > 70).sum())}, below 30: {int((rsi < 30).sum())}")
+    elif label == "MACD":
+        lines.append(f"MACD {latest['MACD']:.{decimals}f}, signal {latest['MACD_signal']:.{decimals}f}, "
+                     f"histogram {latest['MACD_hist']:.{decimals}f} (4-week change {_trend(data['MACD_hist']):+.{decimals}f})")
+        cross = _last_cross(data["MACD"], data["MACD_signal"])
+        if cross:
+            lines.append(f"MACD last crossed {cross.replace(' on', ' signal on')}")
+        cross = _last_cross(data["MACD"], pd.Series(0.0, index=data.index))
+        if cross:
+            lines.append(f"MACD last crossed {cross.replace(' on', ' zero on')}")
+    elif label == "OBV":
+        lines.append(f"OBV {_compact_number(latest['OBV'])}, 4-week change {_compact_number(_trend(data['OBV']))}; "
+                     f"close 4-week change {_trend(close):+.{decimals}f}")
+    elif label == "ADX":
+        strength = "strong trend" if latest["ADX"] > 25 else "weak or no trend" if latest["ADX"] < 20 else "developing trend"
+        lines.append(f"ADX {latest['ADX']:.1f} ({strength}), 4-week change {_trend(data['ADX']):+.1f}, "
+                     f"period high {data['ADX'].max():.1f}")
+    return "\n".join(lines)
+
+
+def format_indicator_prompt(data, label):
+    return (f"Key figures:\n{indicator_digest(data, label)}\n\n"
+            f"Weekly data (CSV):\n{serialize_for_prompt(data, PROMPT_COLUMNS[label])}")
+
+
+def prompt_token_report(data, indicator_jobs):
+    # Token counts of the old markdown tables against the compact prompts, one row per indicator
+    rows = []
+    for label, (_, data_text) in indicator_jobs.items():
+        before = count_tokens(data[MARKDOWN_PROMPT_COLUMNS[label]].to_markdown())
+        after = count_tokens(data_text)
+        rows.append({"Indicator": label, "Markdown tokens": before, "Compact tokens": after})
+    total_before = sum(row["Markdown tokens"] for row in rows)
+    total_after = sum(row["Compact tokens"] for row in rows)
+    rows.append({"Indicator": "Total", "Markdown tokens": total_before, "Compact tokens": total_after})
+    for row in rows:
+        row["Saved"] = f"{1 - row['Compact tokens'] / row['Markdown tokens']:.0%}" if row["Markdown tokens"] else ""
+    return rows
+
+
+def signal_states(data):
+    """
+    Discrete signal state of every indicator on the latest row, e.g. whether the close is above
+    SMA_200 or RSI is overbought. A state is None while its indicator has no value yet.
+    """
+    latest = data.ffill().iloc[-1]
+
+    def above(column, other):
+        if pd.isna(latest[column]) or pd.isna(latest[other]):
+            return None
+        return bool(latest[column] > latest[other])
+
+    rsi, adx, obv_trend = latest["RSI"], latest["ADX"], _trend(data["OBV"])
+    if pd.isna(latest["upper_band"]) or pd.isna(latest["lower_band"]):
+        band_position = None
+    else:
+        band_position = "above" if latest["Close"] > latest["upper_band"] else "below" if latest["Close"] < latest["lower_band"] else "inside"
+    return {
+        "Bollinger Bands": {"position": band_position},
+        "SMA": {
+            "above_sma_20": above("Close", "SMA_20"),
+            "above_sma_50": above("Close", "SMA_50"),
+            "above_sma_200": above("Close", "SMA_200"),
+            "sma_50_above_sma_200": above("SMA_50", "SMA_200"),
+        },
+        "RSI": {"zone": None if pd.isna(rsi) else "overbought" if rsi > 70 else "oversold" if rsi < 30 else "neutral"},
+        "MACD": {"above_signal": above("MACD", "MACD_signal"), "above_zero": None if pd.isna(latest["MACD"]) else bool(latest["MACD"] > 0)},
+        "OBV": {"rising": None if pd.isna(obv_trend) else bool(obv_trend > 0)},
+        "ADX": {"trending": None if pd.isna(adx) else bool(adx > 25)},
+    }
+
+
+def _signal_snapshot_path(ticker, timeframe):
+    name = re.sub(r"[^A-Za-z0-9.^_-]", "_", f"{ticker}_{timeframe}")
+    return os.path.join(SIGNAL_SNAPSHOT_DIR, f"{name}.json")
+
+
+def save_signal_snapshot(ticker, timeframe, states, analyses, summary):
+    _write_cache_file(SIGNAL_SNAPSHOT_DIR, _signal_snapshot_path(ticker, timeframe), {
+        "created": time.time(),
+        "indicators": {label: {"state": states[label], "analysis": analysis} for label, analysis in analyses.items()},
+        "summary": summary,
+    })
+
+
+def prescreen_indicators(ticker, timeframe, data, indicator_jobs):
+    """
+    Compares the current signal states with the ticker's last snapshot and keeps only the
+    indicator jobs whose state changed.
+
+    Returns:
+    - A dict with "jobs" (indicator jobs that still need the LLM), "reused" (label to previous
+      analysis for unchanged indicators), "summary" (the previous summary, only when no
+      indicator changed) and "states" (the current signal states).
+    """
+    states = signal_states(data)
+    snapshot = _read_cache_file(_signal_snapshot_path(ticker, timeframe), SIGNAL_SNAPSHOT_TTL) if SIGNAL_PRESCREEN else None
+    previous = snapshot["indicators"] if snapshot else {}
+
+    jobs, reused = {}, {}
+    for label, job in indicator_jobs.items():
+        entry = previous.get(label)
+        if entry and entry["analysis"] and entry["state"] == states[label]:
+            reused[label] = entry["analysis"]
+        else:
+            jobs[label] = job
+    summary = snapshot["summary"] if snapshot and indicator_jobs and not jobs else ""
+    return {"jobs": jobs, "reused": reused, "summary": summary, "states": states}
+
+
+def build_indicator_jobs(data, macd_available=True):
+    # Maps each indicator label to its analysis function and the compact data it is prompted with
+    functions = {"Bollinger Bands": bollingerbands, "SMA": SMA, "RSI": RSI, "OBV": OBV, "ADX": ADX}
+    # Only call MACD analysis if MACD data is available
+    if macd_available:
+        functions["MACD"] = MACD
+    return {label: (function, format_indicator_prompt(data, label)) for label, function in functions.items()}
+
+
+def summarize_indicators(ticker, analyses):
+    return SUMMARY(
+        ticker,
+        analyses["Bollinger Bands"],
+        analyses["SMA"],
+        analyses["RSI"],
+        analyses.get("MACD", "MACD analysis not available."),
+        analyses["OBV"],
+        analyses["ADX"],
+    )
+
+
+# One narrative per indicator plus the overall conclusion, in a single structured response
+CONSOLIDATED_SYSTEM_PROMPT = (
+    "You are an AI model designed to assist long-term day traders in analyzing stock market data. "
+    "You are given weekly data for one stock and precomputed key figures for several technical indicators. "
+    "For each indicator requested, write a detailed analysis of what it shows about the stock's trend, momentum "
+    "and volume, as you would for that indicator alone. Then write the summary: one paragraph that synthesizes the "
+    "lagging indicators (MACD, SMA) and leading indicators (ADX, RSI, OBV, Bollinger Bands) into a clear conclusion "
+    "on whether the trend is strengthening, weakening or reversing, for a reader with no trading knowledge, and "
+    "give very simple advice on what long term position to take, in bold."
+)
+
+
+def consolidated_schema(labels):
+    # Strict JSON schema for the consolidated response; every field is a markdown string
+    fields = list(labels) + ["Summary"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "indicator_analysis",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {name: {"type": "string"} for name in fields},
+                "required": fields,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def consolidated_prompt(ticker, data, labels, previous=None):
+    # The weekly data is sent once, with only the columns the requested indicators need
+    columns = list(dict.fromkeys(column for label in labels for column in PROMPT_COLUMNS[label]))
+    # Every digest opens with the same line on the latest close, so it is sent once as well
+    digests = [indicator_digest(data, label).split("\n", 1) for label in labels]
+    sections = [digests[0][0]] + [f"### {label}\n{digest[-1]}" for label, digest in zip(labels, digests)]
+    for label, analysis in (previous or {}).items():
+        sections.append(f"### {label} (unchanged since the last analysis; use it for the summary only)\n{analysis}")
+    return (f"Analyze the stock data for {ticker}.\n\nKey figures:\n" + "\n\n".join(sections)
+            + f"\n\nWeekly data (CSV):\n{serialize_for_prompt(data, columns)}")
+
+
+def analyze_indicators_consolidated(ticker, data, labels, previous=None):
+    """
+    Analyzes several indicators and writes the summary in one structured-output request.
+
+    Parameters:
+    - ticker: The ticker symbol.
+    - data: Weekly data with every indicator column.
+    - labels: Indicator labels to analyze.
+    - previous: Optional mapping of label to an earlier analysis, included for the summary only.
+
+    Returns:
+    - (analyses, summary): a dict mapping each label to its analysis, and the summary.
+
+    Raises:
+    - ValueError if the response does not match the schema.
+    """
+    messages = [
+        {"role": "system", "content": CONSOLIDATED_SYSTEM_PROMPT},
+        {"role": "user", "content": consolidated_prompt(ticker, data, labels, previous)},
+    ]
+    response_format = consolidated_schema(labels)
+    # The raw JSON is not streamed; callers pass on each field once the response is parsed
+    with stream_to(None):
+        response = cached_chat_completion(model="gpt-4o", messages=messages, response_format=response_format)
+    fields = list(labels) + ["Summary"]
+    try:
+        values = json.loads(response)
+        if not isinstance(values, dict) or set(values) != set(fields) or not all(isinstance(values[name], str) for name in fields):
+            raise ValueError(f"got fields {sorted(values) if isinstance(values, dict) else type(values).__name__}")
+    except ValueError as exc:
+        # A bad response must not be replayed from the completion cache on every later run
+        evict_cached_completion("gpt-4o", messages, response_format=response_format)
+        raise ValueError(f"Consolidated analysis does not match the schema: {exc}") from exc
+    return {label: values[label] for label in labels}, values["Summary"]
+
+
+def benchmark_indicator_modes(ticker="AAPL", timeframe="1 Year"):
+    """
+    Runs the indicator analyses for one ticker both ways, one request per indicator plus the
+    summary and one consolidated request, and compares wall time, requests and tokens.
+    Makes real OpenAI requests; the completion cache is bypassed.
+    """
+    data = resample_weekly(load_timeframe(ticker, timeframe))
+    if data.empty:
+        raise ValueError(f"No data available for {ticker}")
+    indicator_jobs = build_indicator_jobs(data, indicator_availability(data)["MACD"])
+
+    def multi_call():
+        summarize_indicators(ticker, run_indicator_analyses(ticker, indicator_jobs))
+
+    def consolidated():
+        analyze_indicators_consolidated(ticker, data, list(indicator_jobs))
+
+    rows = []
+    for mode, run in (("Multi-call", multi_call), ("Consolidated", consolidated)):
+        with record_completions() as log:
+            started = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - started
+        rows.append({
+            "mode": mode,
+            "requests": len(log),
+            "seconds": round(seconds, 2),
+            "prompt_tokens": sum(entry["prompt_tokens"] for entry in log),
+            "completion_tokens": sum(entry["completion_tokens"] for entry in log),
+        })
+    table = pd.DataFrame(rows)
+    table["total_tokens"] = table["prompt_tokens"] + table["completion_tokens"]
+    return table
+
+
+def parse_tickers(text):
+    # Accepts symbols separated by commas, semicolons, spaces or new lines; duplicates are dropped
+    return list(dict.fromkeys(symbol.upper() for symbol in re.split(r"[\s,;]+", text) if symbol))
+
+
+def run_watchlist(tickers, timeframe, include_ai=True, max_workers=LLM_MAX_WORKERS, progress=None):
+    """
+    Analyzes a list of tickers in one run.
+
+    Prices are fetched with chunked multi-ticker downloads, indicators are computed per ticker
+    from the shared cache, and every ticker's indicator and summary prompts are scheduled on
+    one bounded worker pool.
+
+    Parameters:
+    - tickers: Ticker symbols to analyze.
+    - timeframe: One of the TIMEFRAME_DAYS options.
+    - include_ai: Whether to run the per-indicator and summary prompts.
+    - max_workers: Maximum number of OpenAI requests in flight at once.
+    - progress: Optional callable taking (fraction complete, message).
+
+    Returns:
+    - A dict with "table", a DataFrame with one row per ticker, and "details", mapping each
+      ticker to its weekly indicator frame, per-indicator analyses and summary.
+    """
+    report = progress or (lambda fraction, message: None)
+    tickers = parse_tickers(" ".join(tickers))
+
+    report(0.05, f"Downloading prices for {len(tickers)} tickers...")
+    prefetch_prices(tickers, INDICATOR_HISTORY_PERIOD)
+
+    details = {}
+    for ticker in tickers:
+        data = load_timeframe(ticker, timeframe)
+        if data.empty:
+            continue
+        macd_available = bool(data[['MACD', 'MACD_signal', 'MACD_hist']].notna().any().any())
+        weekly = resample_weekly(data)
+        jobs = build_indicator_jobs(weekly, macd_available) if include_ai else {}
+        screen = prescreen_indicators(ticker, timeframe, weekly, jobs)
+        details[ticker] = {
+            "data": weekly,
+            "jobs": screen["jobs"],
+            "labels": list(jobs),
+            "analyses": dict(screen["reused"]),
+            "summary": screen["summary"],
+            "states": screen["states"],
+            "changed": list(screen["jobs"]),
+            "error": "",
+        }
+    report(0.2, f"Computed indicators for {len(details)} tickers...")
+
+    if include_ai and details:
+        _run_watchlist_analyses(details, max_workers, report)
+        for ticker, detail in details.items():
+            if not detail["error"]:
+                save_signal_snapshot(ticker, timeframe, detail["states"], detail["analyses"], detail["summary"])
+
+    for detail in details.values():
+        del detail["jobs"]
+    return {"table": watchlist_table(details), "details": details}
+
+
+def _run_watchlist_analyses(details, max_workers, report):
+    # Each ticker's summary is submitted as soon as its own indicator analyses are in; tickers whose
+    # signals are all unchanged keep their previous summary and make no requests at all
+    total = sum(len(detail["jobs"]) + (not detail["summary"]) for detail in details.values())
+    completed = 0
+    if not total:
+        return
+    summarize = bind_context(summarize_indicators)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = {}
+        for ticker, detail in details.items():
+            for label, (analysis, data_text) in detail["jobs"].items():
+                pending[executor.submit(bind_context(analysis), ticker, data_text)] = (ticker, label)
+            if not detail["jobs"] and not detail["summary"]:
+                pending[executor.submit(summarize, ticker, detail["analyses"])] = (ticker, "Summary")
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                ticker, label = pending.pop(future)
+                detail = details[ticker]
+                completed += 1
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    # One failing ticker should not sink the rest of the watchlist; its summary is skipped
+                    if not detail["error"] and label != "Summary":
+                        completed += 1
+                    detail["error"] = detail["error"] or f"{label}: {exc}"
+                    continue
+                if label == "Summary":
+                    detail["summary"] = result
+                    continue
+                detail["analyses"][label] = result
+                if len(detail["analyses"]) == len(detail["labels"]):
+                    pending[executor.submit(summarize, ticker, detail["analyses"])] = (ticker, "Summary")
+            report(0.2 + 0.8 * completed / total, f"AI analysis {completed}/{total} complete...")
+
+
+def watchlist_table(details):
+    rows = []
+    for ticker, detail in details.items():
+        data = detail["data"]
+        last = data.iloc[-1]
+        rows.append({
+            "Ticker": ticker,
+            "Close": round(float(last["Close"]), 2),
+            "Change %": round(float(last["Close"] / data["Close"].iloc[0] - 1) * 100, 2),
+            "RSI": round(float(last["RSI"]), 1),
+            "ADX": round(float(last["ADX"]), 1),
+            "Above SMA 200": bool(last["Close"] > last["SMA_200"]),
+            "MACD Above Signal": bool(last["MACD"] > last["MACD_signal"]),
+            "Changed Signals": ", ".join(detail["changed"]),
+            "Summary": detail["summary"] or detail["error"],
+        })
+    return pd.DataFrame(rows)
+
+
+def render_watchlist(results):
+    st.subheader("Watchlist Results")
+    st.dataframe(results["table"], use_container_width=True, hide_index=True)
+    if not results["details"]:
+        return
+
+    selected = st.selectbox("Drill down into a ticker", list(results["details"]))
+    detail = results["details"][selected]
+    if detail["summary"]:
+        st.subheader(f"Summary for {selected}")
+        st.write(detail["summary"])
+
+    data = detail["data"]
+    for label, plot in (("Bollinger Bands", plot_bbands), ("SMA", plot_sma), ("RSI", plot_rsi),
+                        ("MACD", plot_macd), ("OBV", plot_obv), ("ADX", plot_adx)):
+        with st.expander(f"View Detailed Analysis for {label}"):
+            st.plotly_chart(plot(data))
+            if label in detail["analyses"]:
+                st.write(detail["analyses"][label])
+
+
+def sp500_constituents():
+    """
+    Returns the S&P 500 as a dict of yfinance symbol to company name, read from SP500_URL and
+    kept on disk for a week.
+    """
+    path = os.path.join(PRICE_CACHE_DIR, "sp500.json")
+    entry = _read_cache_file(path, 7 * 24 * 3600)
+    if entry is None:
+        response = _http_session.get(SP500_URL, headers={"User-Agent": "Mozilla/5.0"}, timeout=30)
+        response.raise_for_status()
+        table = pd.read_html(io.StringIO(response.text))[0]
+        # yfinance writes share classes with a dash, e.g. BRK-B
+        names = {str(symbol).replace(".", "-"): name for symbol, name in zip(table["Symbol"], table["Security"])}
+        entry = {"created": time.time(), "names": names}
+        _write_cache_file(PRICE_CACHE_DIR, path, entry)
+    return entry["names"]
+
+
+def load_price_panel(tickers, period=INDICATOR_HISTORY_PERIOD):
+    """
+    Loads daily bars for many tickers into one panel per field.
+
+    Returns:
+    - A dict mapping 'High', 'Low', 'Close' and 'Volume' to a DataFrame of dates x tickers.
+      Tickers without data are left out.
+    """
+    # Built from the entries the prefetch already read, so each ticker's file is read only once
+    entries, _ = fresh_price_entries(tickers, period)
+    start = _period_start(period)
+    frames = {}
+    for ticker, entry in entries.items():
+        bars = entry["data"]
+        bars = bars.loc[bars.index >= start, ["High", "Low", "Close", "Volume"]]
+        if not bars.empty:
+            frames[ticker] = bars
+    if not frames:
+        return {}
+    panel = pd.concat(frames, axis=1).sort_index()
+    return {field: panel.xs(field, axis=1, level=1) for field in ("High", "Low", "Close", "Volume")}
+
+
+# Factor weights of the composite momentum score; each factor is ranked across the universe first
+SCREENER_FACTORS = {"momentum_12_1": 0.4, "sma_200_distance": 0.2, "rsi": 0.15, "obv_slope": 0.15, "adx": 0.1}
+
+
+def momentum_factors(high, low, close, volume):
+    """
+    Momentum factors on the latest row for every column of (dates x tickers) float arrays,
+    computed for all tickers at once with the indicator engine.
+
+    - momentum_12_1: Return from 12 months ago to 1 month ago (252 and 21 sessions).
+    - sma_200_distance: Close relative to its 200-day SMA.
+    - rsi, adx: The 14-period RSI and ADX.
+    - obv_slope: 20-day change in OBV as a fraction of the volume traded, between -1 and 1.
+
+    Returns:
+    - A dict of factor name to a 1-D array with one value per column; NaN where the history
+      is too short.
+    """
+    rows, columns = close.shape
+    missing = np.full(columns, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        momentum = close[-22] / close[-253] - 1 if rows >= 253 else missing
+        sma_200 = close[-200:].mean(axis=0) if rows >= 200 else missing
+        if rows >= 21:
+            obv = _obv(close[-21:], volume[-21:])
+            obv_slope = (obv[-1] - obv[0]) / volume[-20:].sum(axis=0)
+        else:
+            obv_slope = missing
+    return {
+        "momentum_12_1": momentum,
+        "sma_200_distance": close[-1] / sma_200 - 1,
+        "rsi": _rsi(close)[-1],
+        "adx": _adx(high, low, close)[-1],
+        "obv_slope": obv_slope,
+    }
+
+
+def rank_momentum(factors, names=None):
+    """
+    Ranks tickers by a weighted average of their cross-sectional factor percentiles.
+
+    Parameters:
+    - factors: DataFrame indexed by ticker with the SCREENER_FACTORS columns and "close".
+    - names: Optional mapping of ticker to company name.
+
+    Returns:
+    - A DataFrame sorted best first. Tickers without a 12-1 month return are dropped; any other
+      missing factor counts as the median.
+    """
+    factors = factors[factors["momentum_12_1"].notna()]
+    percentiles = factors[list(SCREENER_FACTORS)].rank(pct=True).fillna(0.5)
+    score = sum(percentiles[name] * weight for name, weight in SCREENER_FACTORS.items()) / sum(SCREENER_FACTORS.values())
+    table = pd.DataFrame({
+        "Ticker": factors.index,
+        "Company": [names.get(ticker, "") if names else "" for ticker in factors.index],
+        "Score": (score * 100).round(1).to_numpy(),
+        "12-1M Return %": (factors["momentum_12_1"] * 100).round(1).to_numpy(),
+        "vs SMA 200 %": (factors["sma_200_distance"] * 100).round(1).to_numpy(),
+        "RSI": factors["rsi"].round(1).to_numpy(),
+        "ADX": factors["adx"].round(1).to_numpy(),
+        "OBV Slope": factors["obv_slope"].round(3).to_numpy(),
+        "Close": factors["close"].round(2).to_numpy(),
+    })
+    table = table.sort_values("Score", ascending=False, ignore_index=True)
+    table.insert(0, "Rank", np.arange(1, len(table) + 1))
+    return table
+
+
+def screen_panel(panel, names=None):
+    # Factors and ranking for a panel from load_price_panel() or synthetic_panel()
+    close = panel["Close"].ffill()
+    arrays = [panel["High"].to_numpy(dtype=float), panel["Low"].to_numpy(dtype=float),
+              close.to_numpy(dtype=float), panel["Volume"].fillna(0.0).to_numpy(dtype=float)]
+    factors = pd.DataFrame(momentum_factors(*arrays), index=close.columns)
+    factors["close"] = close.iloc[-1]
+    return rank_momentum(factors, names)
+
+
+def screen_universe(tickers, names=None, progress=None):
+    """
+    Ranks a universe of tickers by momentum from the local price cache.
+
+    Parameters:
+    - tickers: Ticker symbols to screen.
+    - names: Optional mapping of ticker to company name, shown in the table.
+    - progress: Optional callable taking (fraction complete, message).
+
+    Returns:
+    - A dict with "table", every ranked ticker best first, "skipped", tickers without enough
+      history, and "timings", seconds spent loading prices and computing factors.
+    """
+    report = progress or (lambda fraction, message: None)
+    tickers = parse_tickers(" ".join(tickers))
+
+    report(0.05, f"Loading prices for {len(tickers)} tickers...")
+    started = time.perf_counter()
+    panel = load_price_panel(tickers)
+    loaded = time.perf_counter()
+    if not panel:
+        return {"table": pd.DataFrame(), "skipped": tickers, "timings": {"load": loaded - started, "factors": 0.0}}
+
+    report(0.8, f"Ranking {panel['Close'].shape[1]} tickers...")
+    table = screen_panel(panel, names)
+    finished = time.perf_counter()
+    return {
+        "table": table,
+        "skipped": sorted(set(tickers) - set(table["Ticker"])),
+        "timings": {"load": loaded - started, "factors": finished - loaded},
+    }
+
+
+def render_screener(results, top_n):
+    st.subheader("Momentum Screener")
+    table, timings = results["table"], results["timings"]
+    st.caption(f"Ranked {len(table)} tickers in {timings['load'] + timings['factors']:.2f} s "
+               f"(prices {timings['load']:.2f} s, factors {timings['factors']:.3f} s); "
+               f"{len(results['skipped'])} skipped for missing or short history")
+    if table.empty:
+        return
+
+    top = table.head(top_n)
+    st.dataframe(top, use_container_width=True, hide_index=True)
+    selected = st.selectbox("Deep dive into a ticker", list(top["Ticker"]))
+    company = top.set_index("Ticker").at[selected, "Company"] or selected
+    st.button(f"Run Technical Analysis for {selected}", on_click=start_deep_dive, args=(selected, company))
+
+
+@dataclass
+class AnalysisResult:
+    """
+    Everything one pipeline run produces. Text fields stay empty for stages that were not run.
+    """
+    ticker: str
+    company: str
+    timeframe: str
+    data: object = None
+    available: dict = field(default_factory=dict)
+    indicator_analyses: dict = field(default_factory=dict)
+    ta_summary: str = ""
+    news_summary: str = ""
+    news_conclusion: str = ""
+    fa_summary: str = ""
+    combined_summary: str = ""
+    prompt_tokens: list = field(default_factory=list)
+    signals: dict = field(default_factory=dict)
+    reused_analyses: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+    run_id: str = ""
+    spans: list = field(default_factory=list)
+
+    def to_dict(self):
+        result = asdict(self)
+        result["data"] = None if self.data is None else json.loads(self.data.to_json(orient="index", date_format="iso"))
+        return result
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        if values.get("data") is not None:
+            data = pd.DataFrame.from_dict(values["data"], orient="index").astype(float)
+            data.index = pd.to_datetime(data.index).tz_localize(None)
+            values["data"] = data
+        return cls(**values)
+
+
+def indicator_availability(data):
+    return {
+        "Bollinger Bands": bool(data[['upper_band', 'middle_band', 'lower_band']].notna().any().any()),
+        "SMA": bool(data[['SMA_20', 'SMA_50', 'SMA_200']].notna().any().any()),
+        "RSI": bool(data['RSI'].notna().any()),
+        "MACD": bool(data[['MACD', 'MACD_signal', 'MACD_hist']].notna().any().any()),
+        "OBV": bool(data['OBV'].notna().any()),
+        "ADX": bool(data['ADX'].notna().any()),
+    }
+
+
+class StageGraph:
+    """
+    A small dependency-graph executor. Each stage starts on a worker thread as soon as the
+    stages listed in its `after` have finished, so independent stages overlap.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, function, after=()):
+        self.stages[name] = (function, tuple(after))
+
+    @staticmethod
+    def _run_stage(name, function):
+        with span(f"stage {name}"):
+            return function()
+
+    def run(self, poll=None, interval=0.1):
+        """
+        Runs every stage and returns a dict mapping stage name to its return value.
+
+        Parameters:
+        - poll: Optional callable run on the calling thread after every wait, for handling work
+          the stages have queued for it.
+        - interval: Longest time between polls, in seconds.
+
+        The first stage to fail stops any stage that has not started yet, and its exception is
+        raised once the running stages have finished.
+        """
+        results = {}
+        waiting = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as executor:
+            while waiting or running:
+                for name, (function, after) in list(waiting.items()):
+                    if all(dependency in results for dependency in after):
+                        running[executor.submit(bind_context(self._run_stage), name, function)] = name
+                        del waiting[name]
+                if not running:
+                    raise ValueError(f"Stages {sorted(waiting)} depend on missing or circular stages")
+                done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                if poll is not None:
+                    poll()
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
+
+
+def streamed_stage(on_delta, stage):
+    # Streams one pipeline stage's completions to on_delta(stage, delta); a no-op without a callback
+    return stream_to(lambda delta: on_delta(stage, delta)) if on_delta else nullcontext()
+
+
+def run_technical_analysis(ticker, timeframe, result, progress, on_data, on_delta, consolidated=False):
+    # Fills the technical fields of result; returns False when there is no price data
+    data = load_timeframe(ticker, timeframe)
+    if data.empty:
+        result.warnings.append(f"No data available for {ticker}. Please check the ticker symbol and try again.")
+        return False
+    progress(10, "Fetched stock data...")
+
+    result.available = indicator_availability(data)
+    for label, available in result.available.items():
+        if not available:
+            progress(30, f"{label} is not available...")
+
+    with span("resample weekly", bars=len(data)):
+        result.data = resample_weekly(data)
+    on_data(result)
+    progress(60, "Preparing data for AI analysis...")
+
+    with span("prompt build"):
+        indicator_jobs = build_indicator_jobs(result.data, result.available["MACD"])
+    with span("prompt token report"):
+        result.prompt_tokens = prompt_token_report(result.data, indicator_jobs)
+    screen = prescreen_indicators(ticker, timeframe, result.data, indicator_jobs)
+    result.signals = screen["states"]
+    result.reused_analyses = list(screen["reused"])
+    if on_delta:
+        for label, analysis in screen["reused"].items():
+            on_delta(label, analysis)
+
+    progress(65, "Running indicator analyses...")
+    summary = screen["summary"]
+    analyses = None
+    if consolidated and screen["jobs"]:
+        try:
+            analyses, summary = analyze_indicators_consolidated(ticker, result.data, list(screen["jobs"]), screen["reused"])
+        except ValueError as exc:
+            result.warnings.append(f"{exc}. Fell back to one request per indicator.")
+        else:
+            if on_delta:
+                for label, analysis in analyses.items():
+                    on_delta(label, analysis)
+            progress(95, "Indicator analyses complete...")
+    if analyses is None:
+        analyses = run_indicator_analyses(ticker, screen["jobs"], progress, on_delta=on_delta)
+    result.indicator_analyses = {label: screen["reused"].get(label) or analyses[label] for label in indicator_jobs}
+    if summary:
+        result.ta_summary = summary
+        if on_delta:
+            on_delta("ta_summary", result.ta_summary)
+    else:
+        with streamed_stage(on_delta, "ta_summary"):
+            result.ta_summary = summarize_indicators(ticker, result.indicator_analyses)
+    save_signal_snapshot(ticker, timeframe, screen["states"], result.indicator_analyses, result.ta_summary)
+    return True
+
+
+def run_pipeline(ticker, company, timeframe, technical=True, news=False, fundamental=False,
+                 pdf_file=None, pdf_name=None, progress=None, on_data=None, on_delta=None, consolidated=False):
+    """
+    Runs the selected analyses for one ticker without touching the Streamlit UI.
+
+    Parameters:
+    - ticker: The ticker symbol, e.g. 'AAPL'.
+    - company: The full company name used by the news and fundamental prompts.
+    - timeframe: One of the TIMEFRAME_DAYS options.
+    - technical, news, fundamental: Which analyses to run.
+    - pdf_file, pdf_name: Readable binary file and its name, required for fundamental analysis.
+    - consolidated: Analyze the indicators and write their summary in one structured request
+      instead of one request each.
+    - progress: Optional callable taking (percent complete, message).
+    - on_data: Optional callable taking the AnalysisResult once its weekly data and indicator
+      availability are set, before any AI analysis runs.
+    - on_delta: Optional callable taking (stage, text) as AI output streams in. The stage is an
+      indicator label or the name of the AnalysisResult field being written. A text of None
+      means the stage starts over and its earlier text should be discarded.
+
+    All callbacks are invoked on the calling thread.
+
+    Returns:
+    - An AnalysisResult.
+    """
+    progress = progress or (lambda percent, message: None)
+    on_data = on_data or (lambda result: None)
+    result = AnalysisResult(ticker=ticker, company=company, timeframe=timeframe)
+
+    # Stages run on worker threads; their callbacks are queued and replayed on the calling thread
+    events = queue.Queue()
+
+    def on_calling_thread(callback):
+        return (lambda *args: events.put((callback, args))) if callback else None
+
+    def replay():
+        while not events.empty():
+            callback, args = events.get_nowait()
+            callback(*args)
+
+    reached = 0
+
+    def report(percent, message):
+        # Stages overlap, so the bar only moves forward
+        nonlocal reached
+        reached = max(reached, percent)
+        progress(reached, message)
+
+    stage_progress = on_calling_thread(report)
+    stage_data = on_calling_thread(on_data)
+    stage_delta = on_calling_thread(on_delta)
+    graph = StageGraph()
+
+    if technical:
+        def technical_stage():
+            stage_progress(5, "Performing Technical Analysis...")
+            run_technical_analysis(ticker, timeframe, result, stage_progress, stage_data, stage_delta, consolidated)
+        graph.add("technical", technical_stage)
+
+    if news:
+        def news_stage():
+            stage_progress(10, "Gathering news and events...")
+            news_message = generate_company_news_message(company, timeframe)
+            with streamed_stage(stage_delta, "news_summary"):
+                result.news_summary = format_news(news_message)
+            if not technical and not fundamental:
+                with streamed_stage(stage_delta, "news_conclusion"):
+                    result.news_conclusion = txt_conclusion(result.news_summary, company)
+        graph.add("news", news_stage)
+
+    if fundamental:
+        def fundamental_stage():
+            stage_progress(10, "Performing Fundamental Analysis...")
+            with streamed_stage(stage_delta, "fa_summary"):
+                result.fa_summary = FUNDAMENTAL_ANALYSIS(pdf_file, company, pdf_name)
+        graph.add("fundamental", fundamental_stage)
+
+    # A merge is skipped when technical analysis found no price data
+    if technical and news:
+        def merge_news_and_technical():
+            if result.ta_summary:
+                stage_progress(90, "Merging analyses...")
+                with streamed_stage(stage_delta, "combined_summary"):
+                    result.combined_summary = merge_news_and_technical_analysis_summary(
+                        company, result.news_summary, result.ta_summary, timeframe)
+        graph.add("merge news and technical", merge_news_and_technical, after=("technical", "news"))
+
+    if fundamental and technical and not news:
+        def merge_fundamental_and_technical():
+            if result.ta_summary:
+                stage_progress(90, "Merging analyses...")
+                with streamed_stage(stage_delta, "combined_summary"):
+                    result.combined_summary = merge_ta_fa_summary(result.fa_summary, result.ta_summary)
+        graph.add("merge fundamental and technical", merge_fundamental_and_technical, after=("technical", "fundamental"))
+
+    if fundamental and news:
+        def merge_fundamental_and_news():
+            # With technical analysis too, the news side is the merged news and technical summary;
+            # the final merge replaces it, so its streamed text starts over
+            stage_progress(95, "Merging analyses...")
+            news_side = result.combined_summary or result.news_summary
+            if stage_delta and result.combined_summary:
+                stage_delta("combined_summary", None)
+            with streamed_stage(stage_delta, "combined_summary"):
+                result.combined_summary = fa_summary_and_news_summary(result.fa_summary, news_side)
+        after = ("fundamental", "news") + (("merge news and technical",) if technical else ())
+        graph.add("merge fundamental and news", merge_fundamental_and_news, after=after)
+
+    # Every stage's spans, and those of the callbacks replayed here, are recorded under one run ID
+    with trace_run("pipeline", ticker=ticker, timeframe=timeframe) as trace:
+        graph.run(poll=replay)
+        replay()
+    result.run_id = trace.run_id
+    result.spans = list(trace.spans)
+
+    progress(100, "Analysis complete!")
+    return result
+
+
+def run_indicator_analyses(ticker, indicator_jobs, progress=None, max_workers=LLM_MAX_WORKERS, on_delta=None):
+    """
+    Runs the per-indicator OpenAI analyses concurrently on a bounded thread pool.
+
+    Parameters:
+    - ticker: The ticker symbol passed to every analysis function.
+    - indicator_jobs: Mapping of indicator label to (analysis function, markdown table).
+    - progress: Optional callable taking (percent complete, message), called as each indicator finishes.
+    - max_workers: Maximum number of requests in flight at once.
+    - on_delta: Optional callable taking (indicator label, text) as each analysis streams in.
+
+    Returns:
+    - A dict mapping each indicator label to its AI-generated analysis.
+    """
+    results = {}
+    if not indicator_jobs:
+        return results
+
+    # Workers queue streamed text; it is handed to on_delta from the script thread, which is the
+    # only thread allowed to update Streamlit elements
+    deltas = queue.Queue()
+
+    def drain():
+        while not deltas.empty():
+            on_delta(*deltas.get_nowait())
+
+    def analyse(label, sink, analysis, data_text):
+        with span("indicator analysis", indicator=label):
+            return call_streaming(sink, analysis, ticker, data_text)
+
+    workers = max(1, min(max_workers, len(indicator_jobs)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for label, (analysis, data_text) in indicator_jobs.items():
+            sink = (lambda delta, label=label: deltas.put((label, delta))) if on_delta else None
+            futures[executor.submit(bind_context(analyse), label, sink, analysis, data_text)] = label
+        # Progress is reported from the script thread, in completion order
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            if on_delta:
+                drain()
+            for future in done:
+                label = futures[future]
+                results[label] = future.result()
+                if progress is not None:
+                    progress(65 + 30 * len(results) // len(indicator_jobs), f"{label} Analysis complete...")
+    return results
+
+
+class PrecomputeStore:
+    """
+    Pipeline results computed ahead of time, one row per (ticker, timeframe, news) in a SQLite
+    file shared by the scheduler and the app. Safe to share between threads and processes.
+    """
+
+    def __init__(self, path=PRECOMPUTE_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS precomputed ("
+                "ticker TEXT, timeframe TEXT, news INTEGER, company TEXT, computed_at REAL, result TEXT, "
+                "PRIMARY KEY (ticker, timeframe, news))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, ticker, timeframe, news=False, company="", max_age=PRECOMPUTE_MAX_AGE):
+        """
+        Returns {"result": AnalysisResult, "computed_at": aware datetime}, or None when there is
+        no result younger than max_age. News results only match the same company name.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT company, computed_at, result FROM precomputed WHERE ticker = ? AND timeframe = ? AND news = ?",
+                (ticker.strip().upper(), timeframe, int(bool(news))),
+            ).fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        if news and row[0].strip().lower() != company.strip().lower():
+            return None
+        return {
+            "result": AnalysisResult.from_dict(json.loads(row[2])),
+            "computed_at": datetime.fromtimestamp(row[1], MARKET_TZ),
+        }
+
+    def put(self, result, news=False):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO precomputed VALUES (?, ?, ?, ?, ?, ?)",
+                (result.ticker.upper(), result.timeframe, int(bool(news)), result.company, time.time(),
+                 json.dumps(result.to_dict(), default=str)),
+            )
+
+    def freshness(self):
+        # (ticker, timeframe, news, computed_at) of every stored result, newest first
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT ticker, timeframe, news, computed_at FROM precomputed ORDER BY computed_at DESC"
+            ).fetchall()
+
+
+_precompute_store = None
+
+
+def get_precompute_store():
+    global _precompute_store
+    with _result_store_lock:
+        if _precompute_store is None:
+            _precompute_store = PrecomputeStore()
+        return _precompute_store
+
+
+def parse_precompute_watchlist(text):
+    # "AAPL=Apple Inc., MSFT" -> {"AAPL": "Apple Inc.", "MSFT": ""}
+    watchlist = {}
+    for entry in text.split(","):
+        ticker, _, company = entry.partition("=")
+        if ticker.strip():
+            watchlist[ticker.strip().upper()] = company.strip()
+    return watchlist
+
+
+class PrecomputeScheduler:
+    """
+    Runs the pipeline for a watchlist and set of timeframes on weekdays at fixed market-time
+    slots, writing every finished AnalysisResult to a PrecomputeStore.
+
+    At most `workers` tickers are analysed at once; each pipeline still bounds its own OpenAI
+    requests with LLM_MAX_WORKERS.
+    """
+
+    def __init__(self, watchlist, timeframes=None, store=None, workers=PRECOMPUTE_WORKERS,
+                 schedule=PRECOMPUTE_SCHEDULE, news=PRECOMPUTE_NEWS):
+        self.watchlist = watchlist
+        self.timeframes = timeframes or PRECOMPUTE_TIMEFRAMES
+        self.store = store or get_precompute_store()
+        self.workers = max(1, workers)
+        self.slots = sorted(dtime.fromisoformat(slot.strip()) for slot in schedule.split(",") if slot.strip())
+        self.news = news
+        self.stop_event = threading.Event()
+
+    def next_run(self, now=None):
+        # The first weekday slot after now, in market time
+        now = now or datetime.now(MARKET_TZ)
+        day = now.date()
+        while True:
+            if day.weekday() < 5:
+                for slot in self.slots:
+                    candidate = datetime.combine(day, slot, MARKET_TZ)
+                    if candidate > now:
+                        return candidate
+            day += timedelta(days=1)
+
+    def _analyse(self, ticker, company, timeframe):
+        news = self.news and bool(company)
+        with llm_user("precompute"):
+            result = run_pipeline(ticker, company, timeframe, technical=True, news=news)
+        self.store.put(result, news=news)
+        return result
+
+    def run_once(self, report=None):
+        """
+        Analyses every (ticker, timeframe) once.
+
+        Returns:
+        - A dict with the number of results stored and a list of "TICKER timeframe: error" strings.
+        """
+        report = report or (lambda message: None)
+        prefetch_prices(list(self.watchlist), INDICATOR_HISTORY_PERIOD)
+        jobs = [(ticker, company, timeframe) for ticker, company in self.watchlist.items() for timeframe in self.timeframes]
+        stored, errors = 0, []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._analyse, *job): job for job in jobs}
+            for future in as_completed(futures):
+                ticker, _, timeframe = futures[future]
+                try:
+                    future.result()
+                    stored += 1
+                    report(f"Precomputed {ticker} {timeframe} ({stored}/{len(jobs)})")
+                except Exception as exc:
+                    # One failing ticker should not stop the rest of the watchlist
+                    errors.append(f"{ticker} {timeframe}: {exc}")
+                    report(f"Failed {ticker} {timeframe}: {exc}")
+        return {"stored": stored, "errors": errors}
+
+    def serve_forever(self, report=None):
+        # Sleeps until each slot and runs the watchlist, until stop() is called
+        report = report or (lambda message: None)
+        while not self.stop_event.is_set():
+            due = self.next_run()
+            report(f"Next precompute run at {due:%Y-%m-%d %H:%M %Z}")
+            if self.stop_event.wait((due - datetime.now(MARKET_TZ)).total_seconds()):
+                break
+            self.run_once(report)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="precompute-scheduler", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stop_event.set()
+
+
+_precompute_scheduler = None
+
+
+def start_precompute_scheduler():
+    # Starts one scheduler thread per process; later script runs find it already running
+    global _precompute_scheduler
+    with _client_lock:
+        if _precompute_scheduler is None and PRECOMPUTE_WATCHLIST:
+            _precompute_scheduler = PrecomputeScheduler(parse_precompute_watchlist(PRECOMPUTE_WATCHLIST))
+            _precompute_scheduler.start()
+        return _precompute_scheduler
+
+
+class JobCancelled(Exception):
+    pass
+
+
+JOB_FINISHED = ("done", "failed", "cancelled")
+
+
+class AnalysisJobQueue:
+    """
+    Analysis jobs in a SQLite file, shared by the app and any worker processes.
+
+    Each row holds the job's parameters, status (queued, running, done, failed or cancelled),
+    progress, the text streamed so far and, once done, the AnalysisResult as JSON. Rows outlive
+    the browser session, so a refreshed page can pick its job up again.
+    """
+
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT, params TEXT, progress INTEGER, message TEXT, "
+                "partial TEXT, result TEXT, error TEXT, cancel_requested INTEGER, worker TEXT, "
+                "created_at REAL, updated_at REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def submit(self, params):
+        job_id = new_job_id()
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO analysis_jobs VALUES (?, 'queued', ?, 0, 'Queued...', NULL, NULL, NULL, 0, NULL, ?, ?)",
+                (job_id, json.dumps(params), now, now),
+            )
+        return job_id
+
+    def claim(self, worker):
+        # Atomically takes the oldest queued job, or a running one whose worker stopped reporting
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT job_id, params FROM analysis_jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND updated_at < ?) ORDER BY created_at LIMIT 1",
+                (time.time() - JOB_STALE_AFTER,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE analysis_jobs SET status = 'running', worker = ?, updated_at = ? WHERE job_id = ?",
+                    (worker, time.time(), row[0]),
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return None if row is None else {"job_id": row[0], "params": json.loads(row[1])}
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, params, progress, message, partial, result, error, cancel_requested, updated_at "
+                "FROM analysis_jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": job_id,
+            "status": row[0],
+            "params": json.loads(row[1]),
+            "progress": row[2],
+            "message": row[3],
+            "partial": json.loads(row[4]) if row[4] else {},
+            "result": json.loads(row[5]) if row[5] else None,
+            "error": row[6],
+            "cancel_requested": bool(row[7]),
+            "updated_at": row[8],
+        }
+
+    def update(self, job_id, **values):
+        # Sets progress, message or partial; every update also counts as the worker's heartbeat
+        columns = ", ".join(f"{name} = ?" for name in values)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE analysis_jobs SET {columns}, updated_at = ? WHERE job_id = ?",
+                         (*values.values(), time.time(), job_id))
+
+    def finish(self, job_id, status, result=None, error=None):
+        values = {"status": status, "error": error}
+        if result is not None:
+            values.update(result=json.dumps(result.to_dict(), default=str), progress=100, message="Analysis complete!")
+        self.update(job_id, **values)
+
+    def cancel(self, job_id):
+        # Queued jobs are cancelled at once; running ones stop before their next OpenAI request,
+        # result poll or progress update
+        with self._connect() as conn:
+            cancelled = conn.execute("UPDATE analysis_jobs SET status = 'cancelled' WHERE job_id = ? AND status = 'queued'",
+                                     (job_id,)).rowcount
+            conn.execute("UPDATE analysis_jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running'", (job_id,))
+            params = conn.execute("SELECT params FROM analysis_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        # A job that never ran still holds its copy of the uploaded PDF
+        if cancelled and params:
+            remove_job_upload(json.loads(params[0]))
+
+    def cancel_requested(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT cancel_requested FROM analysis_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def cleanup(self, max_age=RESULT_RETENTION):
+        cutoff = time.time() - max_age
+        with self._connect() as conn:
+            expired = conn.execute("SELECT params FROM analysis_jobs WHERE updated_at < ?", (cutoff,)).fetchall()
+            cursor = conn.execute("DELETE FROM analysis_jobs WHERE updated_at < ?", (cutoff,))
+        for (params,) in expired:
+            remove_job_upload(json.loads(params))
+        return cursor.rowcount
+
+
+def remove_job_upload(params):
+    if params.get("pdf_path"):
+        try:
+            os.remove(params["pdf_path"])
+        except OSError:
+            pass
+
+
+_job_queue = None
+
+
+def get_job_queue():
+    global _job_queue
+    with _result_store_lock:
+        if _job_queue is None:
+            _job_queue = AnalysisJobQueue()
+            _job_queue.cleanup()
+        return _job_queue
+
+
+def submit_analysis_job(key, ticker, company, timeframe, technical, news, fundamental, pdf_file=None, consolidated=False):
+    # The PDF is copied to disk so a worker in another thread or process can read it
+    params = {"key": list(key), "ticker": ticker, "company": company, "timeframe": timeframe,
+              "technical": technical, "news": news, "fundamental": fundamental, "pdf_path": None, "pdf_name": None,
+              "consolidated": consolidated, "user": current_llm_user()}
+    if fundamental and pdf_file is not None:
+        params["pdf_path"] = save_upload(pdf_file, suffix=".pdf")
+        params["pdf_name"] = pdf_file.name
+    return get_job_queue().submit(params)
+
+
+def execute_analysis_job(jobs, job_id, params):
+    """
+    Runs one claimed job. Progress and streamed text are written back to the queue (text at
+    most twice a second). A cancellation request stops the job at its next update, result
+    poll or OpenAI request, on whichever stage thread comes to one first.
+    """
+    partial = {"text": {}, "data": None}
+    last_flush = 0.0
+
+    def check_cancelled():
+        if jobs.cancel_requested(job_id):
+            raise JobCancelled()
+
+    def flush(force=False):
+        nonlocal last_flush
+        if force or time.time() - last_flush > 0.5:
+            last_flush = time.time()
+            check_cancelled()
+            jobs.update(job_id, partial=json.dumps(partial, default=str))
+
+    def progress(percent, message):
+        check_cancelled()
+        jobs.update(job_id, progress=int(percent), message=message)
+
+    def on_data(result):
+        partial["data"] = result.to_dict()
+        flush(force=True)
+
+    def on_delta(stage, delta):
+        text = partial["text"]
+        text[stage] = "" if delta is None else text.get(stage, "") + delta
+        flush()
+
+    pdf_file = open(params["pdf_path"], "rb") if params["pdf_path"] else None
+    set_llm_user(params.get("user"))
+    try:
+        # Stage threads inherit the check, so a cancel also stops their webhook waits and OpenAI requests
+        with cancellable(check_cancelled):
+            result = run_pipeline(params["ticker"], params["company"], params["timeframe"],
+                                  technical=params["technical"], news=params["news"], fundamental=params["fundamental"],
+                                  pdf_file=pdf_file, pdf_name=params["pdf_name"], consolidated=params.get("consolidated", False),
+                                  progress=progress, on_data=on_data, on_delta=on_delta)
+        jobs.finish(job_id, "done", result=result)
+    except JobCancelled:
+        jobs.finish(job_id, "cancelled")
+    except Exception as exc:
+        jobs.finish(job_id, "failed", error=f"{type(exc).__name__}: {exc}")
+    finally:
+        if pdf_file is not None:
+            pdf_file.close()
+        remove_job_upload(params)
+
+
+class AnalysisWorkerPool:
+    """
+    `workers` threads that each claim and run one job at a time from an AnalysisJobQueue.
+    Several pools, in this or other processes, can share one queue.
+    """
+
+    def __init__(self, jobs=None, workers=JOB_WORKERS):
+        self.jobs = jobs or get_job_queue()
+        self.workers = max(1, workers)
+        self.stop_event = threading.Event()
+        self.name = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    def _work(self, number):
+        worker = f"{self.name}-{number}"
+        while not self.stop_event.is_set():
+            job = self.jobs.claim(worker)
+            if job is None:
+                self.stop_event.wait(JOB_POLL_INTERVAL)
+                continue
+            execute_analysis_job(self.jobs, job["job_id"], job["params"])
+
+    def start(self):
+        threads = [threading.Thread(target=self._work, args=(number,), name=f"analysis-worker-{number}", daemon=True)
+                   for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        self.stop_event.set()
+
+
+_job_workers = None
+
+
+def start_job_workers():
+    # One worker pool per process; later script runs find it already running
+    global _job_workers
+    with _client_lock:
+        if _job_workers is None:
+            _job_workers = AnalysisWorkerPool()
+            _job_workers.start()
+        return _job_workers
+
+
+def follow_analysis_job(job_id, progress_bar, status_text):
+    """
+    Draws a job's current progress and streamed text. While the job is unfinished the script
+    reruns after JOB_POLL_INTERVAL to draw it again, so no script thread waits out the job.
+    A finished job's result is put in the session store as the current analysis, for the
+    caller to render, and the job is dropped from the URL so later reruns do not follow it.
+    """
+    jobs = get_job_queue()
+    job = jobs.get(job_id)
+    if job is None:
+        # Removed by cleanup, or from another JOB_DB_PATH
+        st.experimental_set_query_params()
+        return
+    key = tuple(job["params"]["key"])
+    if job["status"] == "done":
+        if key not in stored_analyses():
+            store_analysis(key, AnalysisResult.from_dict(job["result"]), trace_render=True)
+        st.session_state["current_analysis"] = key
+        st.experimental_set_query_params()
+        return
+    if job["status"] in JOB_FINISHED:
+        st.experimental_set_query_params()
+        if job["status"] == "failed":
+            st.error(f"Analysis failed: {job['error']}")
+        else:
+            st.warning("Analysis cancelled.")
+        return
+
+    progress_bar.progress(min(100, job["progress"] or 0))
+    status_text.text(job["message"] or "")
+    st.button("Cancel Analysis", on_click=jobs.cancel, args=(job_id,), key="cancel_analysis_job")
+    view = LiveResultView(job["params"]["ticker"], job["params"]["timeframe"])
+    partial = job["partial"]
+    if partial.get("data"):
+        view.show_data(AnalysisResult.from_dict(partial["data"]))
+    for stage, text in partial.get("text", {}).items():
+        view.show_text(stage, text)
+    time.sleep(JOB_POLL_INTERVAL)
+    st.rerun()
+
+
 def update_progress(progress_bar, stage, progress, message):
     progress_bar.progress(progress)
     st.text(message)
@@ -1102,14 +4820,154 @@ def plot_adx(data):
     return fig
 
 
-if __name__=="__main__":
-    main()
-
-
-
-
-
-
+def format_result_text(result):
+    sections = [f"{result.ticker} ({result.company or 'n/a'}) over the past {result.timeframe}"]
+    sections += [f"Warning: {warning}" for warning in result.warnings]
+    for title, text in (("Technical Analysis Summary", result.ta_summary),
+                        ("News and Events", result.news_summary),
+                        ("News Conclusion", result.news_conclusion),
+                        ("Fundamental Analysis", result.fa_summary),
+                        ("Overall Summary", result.combined_summary)):
+        if text:
+            sections.append(f"## {title}\n\n{text}")
+    for label, analysis in result.indicator_analyses.items():
+        sections.append(f"## {label}\n\n{analysis}")
+    return "\n\n".join(sections)
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Run the stock analysis pipeline without the Streamlit UI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    analyze = commands.add_parser("analyze", help="Analyze one ticker")
+    analyze.add_argument("ticker")
+    analyze.add_argument("--company", default="", help="Full company name, required for news and fundamental analysis")
+    analyze.add_argument("--timeframe", choices=list(TIMEFRAME_DAYS), default="1 Year")
+    analyze.add_argument("--technical", action="store_true", help="Run technical analysis (the default when nothing else is selected)")
+    analyze.add_argument("--news", action="store_true", help="Run news and events analysis")
+    analyze.add_argument("--fundamental", metavar="PDF", help="Run fundamental analysis on this PDF")
+    analyze.add_argument("--consolidated", action="store_true", default=INDICATOR_CONSOLIDATED,
+                         help="Analyze all indicators and the summary in one structured request")
+    analyze.add_argument("--json", action="store_true", help="Print the full result as JSON")
+
+    watchlist = commands.add_parser("watchlist", help="Analyze many tickers in one batch")
+    watchlist.add_argument("tickers", nargs="+")
+    watchlist.add_argument("--timeframe", choices=list(TIMEFRAME_DAYS), default="1 Year")
+    watchlist.add_argument("--no-ai", action="store_true", help="Only compute indicators")
+    watchlist.add_argument("--workers", type=int, default=LLM_MAX_WORKERS, help="Maximum OpenAI requests in flight")
+
+    screen = commands.add_parser("screen", help="Rank a universe of tickers by momentum")
+    screen.add_argument("tickers", nargs="*", help="Tickers to screen (defaults to the S&P 500)")
+    screen.add_argument("--top", type=int, default=25, help="Number of tickers to print")
+
+    worker = commands.add_parser("worker", help="Run analysis jobs queued by the app (JOB_MODE=external)")
+    worker.add_argument("--workers", type=int, default=JOB_WORKERS)
+
+    precompute = commands.add_parser("precompute", help="Analyse the PRECOMPUTE_WATCHLIST ahead of time")
+    precompute.add_argument("--watchlist", default=PRECOMPUTE_WATCHLIST, help="Overrides PRECOMPUTE_WATCHLIST")
+    precompute.add_argument("--schedule", action="store_true", help="Keep running at every PRECOMPUTE_SCHEDULE slot")
+
+    backtest = commands.add_parser("backtest", help="Backtest an indicator rule over many tickers")
+    backtest.add_argument("tickers", nargs="+")
+    backtest.add_argument("--strategy", choices=list(BACKTEST_STRATEGIES), default="SMA Crossover")
+    backtest.add_argument("--years", type=int, default=10)
+    backtest.add_argument("--cost-bps", type=float, default=5.0)
+    backtest.add_argument("--sweep", action="store_true", help="Run the strategy's parameter grid")
+
+    spans = commands.add_parser("spans", help="Summarize the exported timing spans across runs")
+    spans.add_argument("--path", default=TRACE_LOG_PATH)
+    spans.add_argument("--run", help="Print the spans of one run instead")
+
+    benchmark = commands.add_parser("benchmark", help="Benchmark the indicator engine against pandas_ta")
+    benchmark.add_argument("--screener", action="store_true", help="Benchmark the momentum screener instead")
+    benchmark.add_argument("--backtester", action="store_true", help="Benchmark the backtester instead")
+    benchmark.add_argument("--indicator-modes", metavar="TICKER", nargs="?", const="AAPL",
+                           help="Compare one-request-per-indicator with the consolidated request on this ticker "
+                                "(makes OpenAI requests)")
+    benchmark.add_argument("--symbols", type=int, help="Universe size (default 1000 for the screener, 500 for the backtester)")
+
+    args = parser.parse_args(argv)
+
+    def report(percent, message):
+        print(f"[{int(percent):3d}%] {message}", file=sys.stderr)
+
+    if args.command == "analyze":
+        if (args.news or args.fundamental) and not args.company:
+            parser.error("--company is required for news and fundamental analysis")
+        options = dict(
+            technical=args.technical or not (args.news or args.fundamental),
+            news=args.news,
+            fundamental=bool(args.fundamental),
+            consolidated=args.consolidated,
+            progress=report,
+        )
+        if args.fundamental:
+            with open(args.fundamental, "rb") as pdf_file:
+                result = run_pipeline(args.ticker, args.company, args.timeframe, pdf_file=pdf_file,
+                                      pdf_name=os.path.basename(args.fundamental), **options)
+        else:
+            result = run_pipeline(args.ticker, args.company, args.timeframe, **options)
+        print(json.dumps(result.to_dict(), indent=2, default=str) if args.json else format_result_text(result))
+
+    elif args.command == "watchlist":
+        results = run_watchlist(args.tickers, args.timeframe, include_ai=not args.no_ai, max_workers=args.workers,
+                                progress=lambda fraction, message: report(fraction * 100, message))
+        print(results["table"].to_string(index=False))
+
+    elif args.command == "screen":
+        names = dict.fromkeys(parse_tickers(" ".join(args.tickers)), "") if args.tickers else sp500_constituents()
+        results = screen_universe(list(names), names, progress=lambda fraction, message: report(fraction * 100, message))
+        report(100, f"Prices {results['timings']['load']:.2f} s, factors {results['timings']['factors']:.3f} s")
+        print(results["table"].head(args.top).to_string(index=False))
+
+    elif args.command == "worker":
+        pool = AnalysisWorkerPool(workers=args.workers)
+        print(f"Running {pool.workers} analysis workers on {pool.jobs.path}", file=sys.stderr)
+        for thread in pool.start():
+            thread.join()
+
+    elif args.command == "precompute":
+        watchlist = parse_precompute_watchlist(args.watchlist)
+        if not watchlist:
+            parser.error("set PRECOMPUTE_WATCHLIST or pass --watchlist")
+        scheduler = PrecomputeScheduler(watchlist)
+        log = lambda message: print(message, file=sys.stderr)
+        if args.schedule:
+            scheduler.serve_forever(log)
+        else:
+            return 1 if scheduler.run_once(log)["errors"] else 0
+
+    elif args.command == "backtest":
+        backtester = load_backtester(args.tickers, args.years, args.cost_bps)
+        if backtester is None:
+            parser.error("no price data was found for these tickers")
+        if args.sweep:
+            print(backtester.sweep(args.strategy).to_string(index=False))
+        else:
+            print(backtester.run(args.strategy).to_string(index=False))
 
+    elif args.command == "spans":
+        records = load_spans(args.path, max_bytes=TRACE_LOG_MAX_BYTES)
+        if args.run:
+            print(span_table([record for record in records if record["run_id"] == args.run]).to_string(index=False))
+        else:
+            print(span_percentiles(records).to_string(index=False))
+
+    elif args.command == "benchmark":
+        if args.indicator_modes:
+            print(benchmark_indicator_modes(args.indicator_modes.upper()).to_string(index=False))
+        elif args.backtester:
+            print(benchmark_backtester(args.symbols or 500).to_string(index=False))
+        elif args.screener:
+            print(benchmark_screener(args.symbols or 1000).to_string(index=False))
+        else:
+            print(benchmark_indicator_engine().to_string(index=False))
+    return 0
 
 
+if __name__=="__main__":
+    # `streamlit run` executes this file inside a Streamlit runtime; plain `python` gets the CLI
+    if st_runtime.exists():
+        main()
+    else:
+        sys.exit(cli())
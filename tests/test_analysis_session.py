@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+# The app imports it at module level
+pytest.importorskip("pandas_ta")
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Momentum_app_2 as app  # noqa: E402
+
+
+def run_app():
+    import Momentum_app_2 as app
+
+    app.main()
+
+
+@pytest.fixture
+def page(tmp_path, monkeypatch):
+    # Jobs go to a private queue and finish as soon as they are submitted, as if a worker had
+    # picked them up between two polls
+    jobs = app.AnalysisJobQueue(str(tmp_path / "jobs.sqlite3"))
+    submit = app.submit_analysis_job
+
+    def submit_and_finish(key, ticker, company, timeframe, *args, **kwargs):
+        job_id = submit(key, ticker, company, timeframe, *args, **kwargs)
+        jobs.finish(job_id, "done", result=app.AnalysisResult(ticker, company, timeframe, ta_summary=f"{ticker} summary"))
+        return job_id
+
+    monkeypatch.setattr(app, "JOB_MODE", "external")
+    monkeypatch.setattr(app, "_job_queue", jobs)
+    monkeypatch.setattr(app, "_precompute_store", app.PrecomputeStore(str(tmp_path / "precomputed.sqlite3")))
+    monkeypatch.setattr(app, "submit_analysis_job", submit_and_finish)
+    at = AppTest.from_function(run_app, default_timeout=30)
+    at.run()
+    return at
+
+
+def click(at, label):
+    next(button for button in at.button if button.label == label).click()
+    at.run()
+
+
+def analyze(at, ticker, company):
+    at.text_input(key="ticker_input").input(ticker)
+    at.text_input(key="company_input").input(company)
+    at.checkbox(key="technical_checkbox").check()
+    click(at, "Run Analysis")
+
+
+def current_ticker(at):
+    return at.session_state["current_analysis"][0]
+
+
+def test_finished_job_leaves_the_url(page):
+    analyze(page, "AAPL", "Apple Inc.")
+    assert current_ticker(page) == "AAPL"
+    assert "job" not in page.query_params
+
+
+def test_reruns_keep_the_stored_result_shown(page):
+    analyze(page, "AAPL", "Apple Inc.")
+    analyze(page, "MSFT", "Microsoft Corporation")
+    # Served from the session store, so no job is submitted
+    analyze(page, "AAPL", "Apple Inc.")
+    assert current_ticker(page) == "AAPL"
+
+    # Any widget change reruns the script without the Run button
+    page.checkbox(key="technical_checkbox").uncheck().run()
+    page.checkbox(key="technical_checkbox").check().run()
+    assert current_ticker(page) == "AAPL"
+    # Running AAPL again counts as a use, so MSFT is evicted first
+    assert [key[0] for key in page.session_state["analysis_results"]] == ["MSFT", "AAPL"]
+
+
+def test_cleared_results_stay_cleared(page):
+    analyze(page, "AAPL", "Apple Inc.")
+    analyze(page, "MSFT", "Microsoft Corporation")
+    click(page, "Clear Stored Analyses")
+    page.run()
+    assert not page.session_state["analysis_results"]
@@ -0,0 +1,75 @@
+import os
+import sys
+from importlib import metadata
+
+import pytest
+
+# The reference implementation; the app imports it too
+pytest.importorskip("pandas_ta")
+
+# The engine reproduces the release pinned in requirements.txt. Later forks changed some
+# definitions (pandas-ta-classic seeds rma with an SMA, for one), so RSI and ADX differ there.
+REFERENCE_VERSION = "0.3.14b0"
+if metadata.version("pandas_ta") != REFERENCE_VERSION:
+    pytest.skip(f"parity is defined against pandas_ta {REFERENCE_VERSION}", allow_module_level=True)
+
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Momentum_app_2 as app  # noqa: E402
+
+# Differences are relative to each column's scale, so OBV in the billions and RSI near 50
+# are held to the same number of significant digits
+RELATIVE_TOLERANCE = 1e-8
+
+
+def gapped_series():
+    # Two years of bars with trading halts: whole weeks and single days missing from the index
+    data = app.synthetic_ohlcv(520, seed=3)
+    keep = np.ones(len(data), dtype=bool)
+    for start, length in ((60, 5), (200, 1), (201, 1), (333, 10), (470, 3)):
+        keep[start:start + length] = False
+    return data[keep]
+
+
+def missing_series():
+    # Two years of bars with missing values mid-series: whole bars, closes only, volumes only,
+    # and a close and volume missing together over several days
+    data = app.synthetic_ohlcv(520, seed=5)
+    for columns, rows in (
+        (['Open', 'High', 'Low', 'Close', 'Volume'], [100, 101, 250, 400, 401, 402]),
+        (['Close'], [120, 300]),
+        (['Volume'], [150, 151, 380]),
+        (['Close', 'Volume'], [210, 211, 212, 330]),
+    ):
+        data.iloc[rows, [data.columns.get_loc(name) for name in columns]] = np.nan
+    return data
+
+
+SERIES = {
+    "1y": lambda: app.synthetic_ohlcv(252, seed=1),
+    "10y": lambda: app.synthetic_ohlcv(2520, seed=2),
+    # Shorter than SMA_50's window; under 34 bars pandas_ta's macd raises instead of returning NaN
+    "short": lambda: app.synthetic_ohlcv(40, seed=4),
+    "gapped": gapped_series,
+    "missing": missing_series,
+}
+
+
+@pytest.mark.parametrize("name", list(SERIES))
+@pytest.mark.parametrize("column", app.INDICATOR_COLUMNS)
+def test_engine_matches_pandas_ta(name, column):
+    data = SERIES[name]()
+    engine = app.add_indicators(data)[column].to_numpy(dtype=float)
+    reference = app.pandas_ta_indicators(data)[column].to_numpy(dtype=float)
+
+    np.testing.assert_array_equal(np.isnan(engine), np.isnan(reference),
+                                  err_msg=f"{column} warm-up differs on the {name} series")
+
+    valid = ~np.isnan(reference)
+    if not valid.any():
+        return
+    scale = max(1.0, float(np.max(np.abs(reference[valid]))))
+    difference = float(np.max(np.abs(engine[valid] - reference[valid])))
+    assert difference <= RELATIVE_TOLERANCE * scale, f"{column} differs by {difference:g} on the {name} series"